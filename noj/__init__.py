@@ -11,7 +11,7 @@ from sqlalchemy import create_engine
 from noj import controller
 from noj.controller.lookup_command import LookupCommand
 from noj.controller.startup_command import StartupCommand
-from noj.model import (db, db_constants, models)
+from noj.model import (db, db_constants, models, indexes)
 from noj.model.models import (Session, Base)
 from noj.model.profiles import ProfileManager
 from noj.view.lookup_gui import LookupGUI
@@ -38,29 +38,34 @@ def init_db(engine):
     Session.configure(bind=engine)
     Base.metadata.create_all(engine)
     session = Session()
-
-    # Insert library types
-    for lib_type, lib_type_id in db_constants.LIB_TYPES_TO_ID.items():
-        db.insert(session, models.LibraryType, name=lib_type, id=lib_type_id)
-
-    # Insert usage example list types
-    for ue_list_type, ue_list_type_id in db_constants.UE_LIST_TYPES_TO_ID.items():
-        db.insert(session, models.UEListType, name=ue_list_type, id=ue_list_type_id)
-
-    # Insert morpheme types
-    for mtype, mtype_id in db_constants.MORPHEME_TYPES_TO_ID.items():
-        db.insert(session, models.MorphemeType, name=mtype, id=mtype_id)
-
-    # Insert morpheme statuses
-    for mstat, mstat_id in db_constants.MORPHEME_STATUSES_TO_ID.items():
-        db.insert(session, models.MorphemeStatus, name=mstat, id=mstat_id)
-
-    # Insert known examples list
-    db.insert(session, models.UEList, name=db_constants.KNOWN_EXAMPLES_NAME, 
-              id=db_constants.KNOWN_EXAMPLES_ID, 
-              type_id=db_constants.UE_LIST_TYPES_TO_ID['SYSTEM'])
-
-    session.commit()
+    db.add_missing_columns(session)
+
+    # The tables were just created, so there is nothing to reindex. The
+    # commit also scores usage examples from before n_score was added.
+    with db.bulk_load(session, drop_indexes=False):
+        # Insert library types
+        for lib_type, lib_type_id in db_constants.LIB_TYPES_TO_ID.items():
+            db.insert(session, models.LibraryType, name=lib_type, id=lib_type_id)
+
+        # Insert usage example list types
+        for ue_list_type, ue_list_type_id in db_constants.UE_LIST_TYPES_TO_ID.items():
+            db.insert(session, models.UEListType, name=ue_list_type, id=ue_list_type_id)
+
+        # Insert morpheme types
+        for mtype, mtype_id in db_constants.MORPHEME_TYPES_TO_ID.items():
+            db.insert(session, models.MorphemeType, name=mtype, id=mtype_id)
+
+        # Insert morpheme statuses
+        for mstat, mstat_id in db_constants.MORPHEME_STATUSES_TO_ID.items():
+            db.insert(session, models.MorphemeStatus, name=mstat, id=mstat_id)
+
+        # Insert known examples list
+        db.insert(session, models.UEList, name=db_constants.KNOWN_EXAMPLES_NAME, 
+                  id=db_constants.KNOWN_EXAMPLES_ID, 
+                  type_id=db_constants.UE_LIST_TYPES_TO_ID['SYSTEM'])
+
+    # create_all does not add indexes to existing tables
+    indexes.create_indexes(session)
     session.close()
 
 # from http://www.riverbankcomputing.com/pipermail/pyqt/2009-May/022961.html
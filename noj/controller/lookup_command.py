@@ -17,8 +17,9 @@ class LookupCommand(SimpleCommand, ICommand):
         lookup_mediator.prepareForSearch(search_word)
         # lookup_callback = lookup_mediator.lookup_done
         lookup_proxy.lookup_entries(search_word, limit=50)
-        lookup_proxy.lookup_ues_by_entry(search_word, limit=50)
-        lookup_proxy.lookup_ues_by_expression(search_word, limit=50)
+        # Common words are not counted in full, the headings show "50 of 1000+"
+        lookup_proxy.lookup_ues_by_entry(search_word, limit=50, exact_count=False)
+        lookup_proxy.lookup_ues_by_expression(search_word, limit=50, exact_count=False)
         # self.sendNotification(noj.AppFacade.LOOKUP_DONE, None)
         # lookup_mediator.test()
         print 'lookup command done'
@@ -2,23 +2,29 @@
 # -*- coding: utf-8 -*-
 import abc
 import json
+from functools import partial
 from noj.model import (
     models,
     db,
     db_constants,
 )
 import noj.tools.entry_unformatter as uf
+from noj.importers.import_writers import DirectWriter
+from noj.importers.import_cache import ImporterCache
 from sqlalchemy.sql import and_, select, func, bindparam
 
 
 class AbstractImporterVisitor(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, session, parser):
+    def __init__(self, session, parser, writer=None, cache=None,
+                 parse_cache=None):
         super(AbstractImporterVisitor, self).__init__()
         self.session = session
         self.parser = parser
-        self.morpheme_cache = dict() # (morpheme-unicode, type_id) -> morpheme-id
+        self.writer = writer or DirectWriter(session)
+        self.cache = cache or ImporterCache()
+        self.parse_cache = parse_cache
 
         self.lib_obj = None
         self.lib_id = None
@@ -47,13 +53,24 @@ class AbstractImporterVisitor(object):
         self.lib_obj.extra = extra
 
     def visit_finish_library(self):
-        self.lib_id = db.insert_orm(self.session, self.lib_obj)[0]
+        self.lib_id = self.writer.insert_orm(self.lib_obj)[0]
+
+    def visit_update_library_extra(self, extra):
+        """Replaces the extra of the library after it was imported."""
+        self.writer.flush()
+        libraries = models.Library.__table__
+        self.session.execute(libraries.update().\
+                             where(libraries.c.id==self.lib_id).\
+                             values(extra=extra))
 
     def visit_usage_example(self, ue_type):
         self.ue_obj = models.UsageExample(library_id=self.lib_id)
 
         ue_type = ue_type.upper()
-        ue_type_id = db.insert(self.session, models.UEType, name=ue_type)[0]
+        ue_type_id = self.cache.ue_types.get(ue_type)
+        if ue_type_id is None:
+            ue_type_id = self.writer.insert(models.UEType, name=ue_type)[0]
+            self.cache.ue_types.set(ue_type, ue_type_id)
         self.ue_obj.type_id = ue_type_id
 
     def visit_expression(self, expression):
@@ -82,41 +99,75 @@ class AbstractImporterVisitor(object):
     def visit_finish_usage_example(self, number):
         pass
 
-    def visit_finish(self):
+    def visit_remove_usage_example(self, expression):
+        """Called for usage examples no longer in the source of the library.
+
+        They are kept in the library; decorators may take them off lists.
+        """
         pass
 
+    def visit_finish(self):
+        self.writer.flush()
+        if self.parse_cache is not None:
+            self.parse_cache.commit()
+
+    def visit_checkpoint(self):
+        """Writes buffered rows and returns the state needed to resume."""
+        self.writer.flush()
+        return {'lib_id': self.lib_id}
+
+    def visit_resume(self, state):
+        """Restores the state returned by visit_checkpoint."""
+        self.lib_id = state['lib_id']
+
     def _copy_media(self, ue_obj):
         pass
 
+    def _copy_media_if_new(self, new):
+        if new:
+            self._copy_media(self.ue_obj)
+        elif new is None:
+            self.writer.when_new(models.UsageExample, self.ue_id,
+                                 partial(self._copy_media, self.ue_obj))
+
     def _import_expression(self, expression):
-        expression_id, new = db.insert(self.session, models.Expression, 
-                                       expression=expression)
+        expression_id = self.cache.expressions.get(expression)
+        if expression_id is not None:
+            return expression_id
+
+        expression_id, new = self.writer.insert(models.Expression, 
+                                                expression=expression)
+        self.cache.expressions.set(expression, expression_id)
         if new:
-            morpheme_list = self._import_parse_morphemes(expression)
-            if len(morpheme_list) > 0:
-                for m in morpheme_list:
-                    m['expression_id'] = expression_id
-                db.insert_many(self.session, models.ExpressionConsistsOf, 
-                               morpheme_list)
+            self._import_expression_morphemes(expression, expression_id)
+        elif new is None:
+            # Not parsed unless the writer finds the expression is new
+            self.writer.when_new(models.Expression, expression_id,
+                partial(self._import_expression_morphemes, expression,
+                        expression_id))
 
         return expression_id
 
+    def _import_expression_morphemes(self, expression, expression_id):
+        morpheme_list = self._import_parse_morphemes(expression)
+        if len(morpheme_list) > 0:
+            for m in morpheme_list:
+                m['expression_id'] = expression_id
+            self.writer.insert_many(models.ExpressionConsistsOf, 
+                                    morpheme_list)
+
     def _import_parse_morphemes(self, line):
-        results = self.parser.parse(line or '')
+        line = line or ''
+        if self.parse_cache is not None:
+            results = self.parse_cache.parse(self.parser, line)
+        else:
+            results = self.parser.parse(line)
 
         # For bulk inserting the morpheme-expression association tuples
         morpheme_list = list()  # list of dicts representing fields
 
         for m in results:
-            # Insert or get morpheme, (morpheme, type_id) unique
-            morpheme_key = (m.base, m.type_)
-            if morpheme_key in self.morpheme_cache:
-                morpheme_id = self.morpheme_cache[morpheme_key]
-            else:
-                morpheme_id, new_morpheme, morpheme = db.insert_get(self.session, 
-                    models.Morpheme, morpheme=m.base, type_id=m.type_,
-                    status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])
-                self.morpheme_cache[morpheme_key] = morpheme_id
+            morpheme_id = self._import_morpheme(m.base, m.type_)
 
             # Bulk insert later
             morpheme_list.append({'morpheme_id':morpheme_id,
@@ -127,11 +178,24 @@ class AbstractImporterVisitor(object):
 
         return morpheme_list
 
+    def _import_morpheme(self, morpheme, type_id):
+        # Insert or get morpheme, (morpheme, type_id) unique
+        morpheme_id = self.cache.get_morpheme(morpheme, type_id)
+        if morpheme_id is None:
+            morpheme_id = self.writer.insert(models.Morpheme, 
+                morpheme=morpheme, type_id=type_id,
+                status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])[0]
+            self.cache.set_morpheme(morpheme, type_id, morpheme_id)
+        return morpheme_id
+
 class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, session, parser):
-        super(AbstractDictionaryImporterVisitor, self).__init__(session, parser)
+    def __init__(self, session, parser, writer=None, cache=None,
+                 parse_cache=None):
+        super(AbstractDictionaryImporterVisitor, self).__init__(session, parser,
+                                                                writer, cache,
+                                                                parse_cache)
         self.entry_obj = None
         self.entry_id = None
         self.eformat = None
@@ -148,7 +212,10 @@ class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
 
     def visit_entry_format(self, eformat):
         self.eformat = eformat
-        eformat_id = db.insert(self.session, models.EntryFormat, name=self.eformat)[0]
+        eformat_id = self.cache.entry_formats.get(eformat)
+        if eformat_id is None:
+            eformat_id = self.writer.insert(models.EntryFormat, name=eformat)[0]
+            self.cache.entry_formats.set(eformat, eformat_id)
         self.entry_obj.format_id = eformat_id
 
     def visit_kana_raw_list(self, kana_raw_list):
@@ -164,43 +231,38 @@ class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
         self.entry_obj.extra = extra
 
     def visit_construct_entry(self):
-        self.entry_id = db.insert_orm(self.session, self.entry_obj)[0]
+        self.entry_id = self.writer.insert_orm(self.entry_obj)[0]
 
     def visit_kana_list(self, kana_list):
         entry_kana = list()
         if self.eformat == 'J-J1':
             for i, kana_text in enumerate(kana_list):
-                kana_id = db.insert(self.session, models.Morpheme, 
-                    morpheme=uf.unformat_jj1_kana(kana_text),
-                    type_id=db_constants.MORPHEME_TYPES_TO_ID['KANA_ENTRY'],
-                    status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])[0]
+                kana_id = self._import_morpheme(uf.unformat_jj1_kana(kana_text),
+                    db_constants.MORPHEME_TYPES_TO_ID['KANA_ENTRY'])
                 entry_kana.append({'entry_id':self.entry_id, 'kana_id':kana_id, 'number':i+1})
                 self.last_kana_text = kana_text
         else:
             for i, kana_text in enumerate(kana_list):
-                kana_id = db.insert(self.session, models.Morpheme, morpheme=kana_text,
-                    type_id=db_constants.MORPHEME_TYPES_TO_ID['KANA_ENTRY'],
-                    status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])[0]
+                kana_id = self._import_morpheme(kana_text,
+                    db_constants.MORPHEME_TYPES_TO_ID['KANA_ENTRY'])
                 entry_kana.append({'entry_id':self.entry_id, 'kana_id':kana_id, 'number':i+1})
-        db.insert_many(self.session, models.EntryHasKana, entry_kana)
+        self.writer.insert_many(models.EntryHasKana, entry_kana)
 
     def visit_kanji_list(self, kanji_list):
         entry_kanji = list()
         if self.eformat == 'J-J1':
             for i, kanji_text in enumerate(kanji_list):
                 assert(self.last_kana_text is not None)
-                kanji_id = db.insert(self.session, models.Morpheme, 
-                    morpheme=uf.unformat_jj1_kanji(kanji_text, self.last_kana_text),
-                    type_id=db_constants.MORPHEME_TYPES_TO_ID['KANJI_ENTRY'],
-                    status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])[0]
+                kanji_id = self._import_morpheme(
+                    uf.unformat_jj1_kanji(kanji_text, self.last_kana_text),
+                    db_constants.MORPHEME_TYPES_TO_ID['KANJI_ENTRY'])
                 entry_kanji.append({'entry_id':self.entry_id, 'kanji_id':kanji_id, 'number':i+1})
         else:
             for i, kanji_text in enumerate(kanji_list):
-                kanji_id = db.insert(self.session, models.Morpheme, morpheme=kanji_text,
-                    type_id=db_constants.MORPHEME_TYPES_TO_ID['KANJI_ENTRY'],
-                    status_id=db_constants.MORPHEME_STATUSES_TO_ID['AUTO'])[0]
+                kanji_id = self._import_morpheme(kanji_text,
+                    db_constants.MORPHEME_TYPES_TO_ID['KANJI_ENTRY'])
                 entry_kanji.append({'entry_id':self.entry_id, 'kanji_id':kanji_id, 'number':i+1})
-        db.insert_many(self.session, models.EntryHasKanji, entry_kanji)
+        self.writer.insert_many(models.EntryHasKanji, entry_kanji)
 
     def visit_definition(self, number):
         self.def_id_stack.append(self.def_id)
@@ -223,7 +285,7 @@ class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
         self.def_obj.extra = extra
 
     def visit_construct_definition(self):
-        self.def_id = db.insert_orm(self.session, self.def_obj)[0]
+        self.def_id = self.writer.insert_orm(self.def_obj)[0]
         if self.eformat == 'J-J1':
             self._import_definition_assocs(self.def_obj.definition, self.def_id)
 
@@ -231,7 +293,7 @@ class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
         self.def_id = self.def_id_stack.pop()
 
     def visit_finish_definition_ues(self):
-        db.insert_many(self.session, models.DefinitionHasUEs, self.definition_ues)
+        self.writer.insert_many(models.DefinitionHasUEs, self.definition_ues)
 
     def _import_definition_assocs(self, def_text, def_id):
         if def_text is not None:
@@ -239,31 +301,46 @@ class AbstractDictionaryImporterVisitor(AbstractImporterVisitor):
             if len(morpheme_list) > 0:
                 for m in morpheme_list:
                     m['definition_id'] = def_id
-                db.insert_many(self.session, models.DefinitionConsistsOf, 
-                               morpheme_list)
+                self.writer.insert_many(models.DefinitionConsistsOf, 
+                                        morpheme_list)
+
+    def visit_finish_entry(self):
+        self.writer.entry_finished()
+
+    def visit_checkpoint(self):
+        state = super(AbstractDictionaryImporterVisitor, self).visit_checkpoint()
+        state['def_id'] = self.def_id
+        state['def_id_stack'] = self.def_id_stack
+        return state
+
+    def visit_resume(self, state):
+        super(AbstractDictionaryImporterVisitor, self).visit_resume(state)
+        self.def_id = state['def_id']
+        self.def_id_stack = state['def_id_stack']
 
     def visit_finish_usage_example(self, number):
-        self.ue_id, new = db.insert_orm(self.session, self.ue_obj)
+        self.ue_id, new = self.writer.insert_orm(self.ue_obj)
 
         self.definition_ues.append({'usage_example_id': self.ue_id, 'definition_id': self.def_id,
                                'number': number})
 
-        if new:
-            self._copy_media(self.ue_obj)
+        self._copy_media_if_new(new)
 
 class AbstractCorpusImporterVisitor(AbstractImporterVisitor):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, session, parser):
-        super(AbstractCorpusImporterVisitor, self).__init__(session, parser)
+    def __init__(self, session, parser, writer=None, cache=None,
+                 parse_cache=None):
+        super(AbstractCorpusImporterVisitor, self).__init__(session, parser,
+                                                            writer, cache,
+                                                            parse_cache)
 
     def visit_finish_usage_example(self, number):
         # number parameter is not used in corpus import
-        self.ue_id, new = db.insert_orm(self.session, self.ue_obj)
+        self.ue_id, new = self.writer.insert_orm(self.ue_obj)
 
         # copy the sound and image files if new
-        if new:
-            self._copy_media(self.ue_obj)
+        self._copy_media_if_new(new)
 
 # For corpus only
 class UpdateImporterDecorator(object):
@@ -292,72 +369,107 @@ class UpdateImporterDecorator(object):
     def visit_finish_library(self):
         self.importer.lib_id = db.insert_orm_or_replace(self.importer.session, self.importer.lib_obj)
 
+class ReplaceImporterDecorator(object):
+    """Replaces the libraries with the name of the imported library.
+
+    Libraries with the same name are deleted when the import finishes, in
+    its last transaction, instead of keeping a duplicate; an import that
+    fails keeps them. If collect_garbage is True, expressions and
+    morphemes left unused are deleted as well. session is the database
+    holding the libraries to replace; it defaults to the importer's
+    session. If it is another one (e.g. for a staged import), the
+    libraries are only listed in replaced_library_ids when the library is
+    visited, to be deleted by merge_staging_database in the merge
+    transaction, and garbage is left for the caller to collect after the
+    merge.
+    """
+    def __init__(self, importer, session=None, collect_garbage=True):
+        super(ReplaceImporterDecorator, self).__init__()
+        self.importer = importer
+        self.library_session = session
+        self.collect_garbage = collect_garbage
+        self.replaced_library_ids = list()
+
+    def __getattr__(self, name):
+        return getattr(self.importer, name)
+
+    def _is_deferred(self):
+        return (self.library_session is not None and
+                self.library_session is not self.importer.session)
+
+    def visit_library(self, lib_name):
+        if self._is_deferred():
+            libraries = models.Library.__table__
+            s = select([libraries.c.id], libraries.c.name==lib_name)
+            self.replaced_library_ids = [row.id for row in
+                                         self.library_session.execute(s)]
+        self.importer.visit_library(lib_name)
+
+    def visit_finish(self):
+        self.importer.visit_finish()
+        if self._is_deferred():
+            return
+        # Looked up by the new library's name, which a resumed import has
+        # not visited
+        session = self.importer.session
+        libraries = models.Library.__table__
+        name = select([libraries.c.name], libraries.c.id==self.importer.lib_id)
+        s = select([libraries.c.id], and_(libraries.c.name==name.as_scalar(),
+                                          libraries.c.id!=self.importer.lib_id))
+        self.replaced_library_ids = [row.id for row in session.execute(s)]
+        for lib_id in self.replaced_library_ids:
+            db.delete_library(session, lib_id)
+        if self.collect_garbage:
+            db.collect_garbage(session)
+
 # MAYBE: generalize to arbitrary list
 class IntoKnownImporterDecorator(object):
-    """docstring for IntoKnownImporterDecorator"""
-    def __init__(self, importer):
+    """Adds the imported usage examples to the Known Examples list.
+
+    Morpheme expr_counts are recomputed with a set-based recount when the
+    import finishes. If incremental is True only the morphemes of the
+    imported expressions are recounted, otherwise every count is.
+    """
+    def __init__(self, importer, incremental=True):
         super(IntoKnownImporterDecorator, self).__init__()
         self.importer = importer
         self.ue_list_id = db_constants.KNOWN_EXAMPLES_ID
-        # To reduce morpheme lookups
-        self.morpheme_count = dict() # morpheme-id -> absolute count
+        self.incremental = incremental
+        self.expression_ids = set() # expressions whose morphemes to recount
 
     def __getattr__(self, name):
         return getattr(self.importer, name)
 
     def visit_finish_usage_example(self, number):
         self.importer.visit_finish_usage_example(number)
-
-        # if its a new expression, should be able to short circuit
-        self._stage_morpheme_counts(self.importer.ue_obj.expression_id)
+        self.expression_ids.add(self.importer.ue_obj.expression_id)
 
         # Insert usage example into usage example list, no need to retrieve tuple
         db.insert_many_core(self.importer.session, models.ue_part_of_list, [{
                             'ue_list_id':self.ue_list_id,
                             'usage_example_id':self.importer.ue_id}])
 
-    def visit_finish(self):
-        self.importer.visit_finish()
+    def visit_remove_usage_example(self, expression):
+        self.importer.visit_remove_usage_example(expression)
 
-        # Update counts
-        morpheme_count_updater = models.Morpheme.__table__.\
-            update().where(models.Morpheme.__table__.c.id==bindparam('m_id')).\
-            values(expr_count=bindparam('new_count'))
-
-        morpheme_count_tuples = list()
-        for morpheme_id, count in self.morpheme_count.items():
-            morpheme_count_tuples.append({'m_id':morpheme_id, 'new_count':count})
-            
-        if morpheme_count_tuples:
-            self.importer.session.execute(morpheme_count_updater, morpheme_count_tuples)
-
-    def _stage_morpheme_counts(self, expression_id):
-        # Only stages morphemes from new expressions to be inserted to the list
-        # Note: this should be done before mapping the expression to the list
-        usage_examples  = models.UsageExample.__table__
-        expression_consists_of = models.ExpressionConsistsOf.__table__
-        morphemes = models.Morpheme.__table__
+        usage_examples = models.UsageExample.__table__
+        expressions = models.Expression.__table__
         ue_part_of_list = models.ue_part_of_list
+        s = select([usage_examples.c.id, usage_examples.c.expression_id],
+            from_obj=[usage_examples.join(expressions)],
+            whereclause=and_(usage_examples.c.library_id==self.importer.lib_id,
+                             expressions.c.expression==expression))
+        row = self.importer.session.execute(s).first()
+        if row is not None:
+            self.importer.session.execute(ue_part_of_list.delete().where(
+                and_(ue_part_of_list.c.ue_list_id==self.ue_list_id,
+                     ue_part_of_list.c.usage_example_id==row.id)))
+            self.expression_ids.add(row.expression_id)
 
-        # Count number of times expression appears in list
-        s = select([func.count(usage_examples.c.id)], 
-            from_obj=[usage_examples.join(ue_part_of_list)],
-            whereclause=and_(ue_part_of_list.c.ue_list_id==self.ue_list_id,
-                             usage_examples.c.expression_id==expression_id))
-        num_same_expressions = self.importer.session.execute(s).first()[0]
-
-        # Increment counts if expression not in list
-        if num_same_expressions == 0:
-            s = select([morphemes], 
-                from_obj=[expression_consists_of.join(morphemes)], 
-                whereclause=expression_consists_of.c.expression_id==expression_id)
-            for m in self.importer.session.execute(s):
-                if m.id in self.morpheme_count:
-                    self.morpheme_count[m.id] += 1
-                else:
-                    self.morpheme_count[m.id] = (m.expr_count or 0) + 1
-        
-
-
-
+    def visit_finish(self):
+        self.importer.visit_finish()
 
+        # Update counts
+        expression_ids = self.expression_ids if self.incremental else None
+        db.recount_morpheme_expr_counts(self.importer.session, self.ue_list_id,
+                                        expression_ids)
@@ -5,9 +5,10 @@ from datetime import datetime
 import os
 import re
 import json
-import shutil
+import logging
 from sqlalchemy.sql import and_, select, func, bindparam
 from anki import Collection
+from anki.utils import ids2str
 from pyparsing import *
 from textwrap import dedent
 from noj.misc.uni_printer import UniPrinter
@@ -18,6 +19,8 @@ from noj.model import (
 )
 from noj.tools.japanese_parser import JapaneseParser
 import noj.tools.entry_unformatter as uf
+from noj.importers.anki_collection_reader import AnkiCollectionReader
+from noj.importers.media_copier import MediaCopier
 from noj.importers.abstract_importer import (
     AbstractCorpusImporterVisitor,
     UpdateImporterDecorator, 
@@ -41,10 +44,23 @@ imgRegexps = [
 regexps = soundRegexps + imgRegexps
 
 class AnkiWalker(object):
-    """Traverses an Anki deck while taking a visitor."""
+    """Traverses an Anki deck while taking a visitor.
+
+    The reviewed, unsuspended notes of the deck are imported. The note ids
+    and the latest note modification time of each sync are stored in the
+    library's extra under "anki_sync". If incremental is True, notes that
+    were already imported and have not been modified since the last sync
+    are skipped. Usage examples of notes that were deleted or suspended
+    since the last sync are passed to visit_remove_usage_example.
+
+    If direct_read is True, the fields of the notes are read in bulk from
+    the collection file by an AnkiCollectionReader instead of building a
+    Note for each note.
+    """
     def __init__(self, collection_path, deck_name, lib_name=None,
                  expression_field=u'Expression', meaning_field=u'Meaning',
-                 sound_field=None, image_field=None):
+                 sound_field=None, image_field=None, incremental=True,
+                 direct_read=False):
         super(AnkiWalker, self).__init__()
         self.collection_path = collection_path
         self.deck_name = deck_name
@@ -53,6 +69,8 @@ class AnkiWalker(object):
         self.meaning_field = meaning_field
         self.sound_field = sound_field
         self.image_field = image_field
+        self.incremental = incremental
+        self.direct_read = direct_read
         self.col = None
         self.ids = None
         self.media_dir = None
@@ -64,7 +82,8 @@ class AnkiWalker(object):
 
     def load_collection(self):
         self.col = Collection(self.collection_path, lock=False)
-        self.ids = self.col.findNotes("\"deck:" + self.deck_name + "\" is:review")
+        self.ids = self.col.findNotes("\"deck:" + self.deck_name +
+                                      "\" is:review -is:suspended")
         self.media_dir = re.sub("(?i)\.(anki2)$", ".media", self.col.path)
 
     def import_generator(self, visitor):
@@ -74,20 +93,81 @@ class AnkiWalker(object):
         if self.ids is None:
             self.load_collection()
 
-        visitor.visit_collection(self.col)
-        visitor.visit_library(self.lib_name)
-        visitor.visit_library_date(datetime.now().date().isoformat())
-        visitor.visit_finish_library()
-
-        for i, note_id in enumerate(self.ids):  # Loop over all notes in deck
-            self._usage_example_accept(note_id, visitor)
-            yield i
-
-        visitor.visit_finish()
-
-    def _usage_example_accept(self, note_id, visitor):
-        # Get or create
-        note = self.col.getNote(note_id)
+        # A sync only touches a few rows, so rebuilding the indexes of the
+        # dictionary tables would cost more than it saves
+        with db.bulk_load(visitor.session, drop_indexes=False) as loader:
+            visitor.visit_collection(self.col)
+            visitor.visit_library(self.lib_name)
+            visitor.visit_library_date(datetime.now().date().isoformat())
+            visitor.visit_finish_library()
+
+            extra = self._load_library_extra(visitor.session)
+            sync = extra.get('anki_sync', dict())
+            synced_notes = sync.get('notes', dict()) # note id -> expression
+            last_mod = sync.get('mod') if self.incremental else None
+
+            note_mods = dict(self.col.db.all(
+                "select id, mod from notes where id in " + ids2str(self.ids)))
+            notes = dict()
+            changed_ids = list()
+            for note_id in self.ids:  # Loop over all notes in deck
+                key = str(note_id)
+                # Notes modified in the second of the last sync are reimported
+                if last_mod is not None and key in synced_notes and \
+                        note_mods[note_id] < last_mod:
+                    notes[key] = synced_notes[key]
+                else:
+                    changed_ids.append(note_id)
+
+            i = len(self.ids) - len(changed_ids)
+            for note_id, note in self._notes(changed_ids):
+                notes[str(note_id)] = self._usage_example_accept(note, visitor)
+                loader.step()
+                yield i
+                i += 1
+
+            # Deleted, suspended or edited notes may leave expressions behind
+            removed = set(synced_notes.values()) - set(notes.values())
+            for expression in removed - set([None]):
+                visitor.visit_remove_usage_example(expression)
+
+            mods = note_mods.values() or [sync.get('mod')]
+            extra['anki_sync'] = {'mod': max(mods),
+                                  'usn': self.col.usn(),
+                                  'notes': notes}
+            visitor.visit_update_library_extra(json.dumps(extra))
+
+            visitor.visit_finish()
+
+    def _load_library_extra(self, session):
+        lib_obj = session.query(models.Library).\
+            filter(models.Library.name==self.lib_name).first()
+        if lib_obj is None or lib_obj.extra is None:
+            return dict()
+        try:
+            return json.loads(lib_obj.extra)
+        except ValueError:
+            return dict()
+
+    def _notes(self, note_ids):
+        """Yields (note id, note) where note maps field names to values."""
+        if self.direct_read:
+            fields = [f for f in (self.expression_field, self.meaning_field,
+                                  self.sound_field, self.image_field)
+                      if f is not None]
+            reader = AnkiCollectionReader(self.collection_path)
+            try:
+                for note_id, note in reader.iter_notes(note_ids, fields):
+                    yield note_id, note
+            finally:
+                reader.close()
+        else:
+            for note_id in note_ids:
+                yield note_id, self.col.getNote(note_id)
+
+    def _usage_example_accept(self, note, visitor):
+        """Visits the note's usage example, returns its expression or None
+        if the note has no expression field."""
         keys = note.keys()
 
 
@@ -104,6 +184,8 @@ class AnkiWalker(object):
             self._media_accept(note, keys, visitor)
 
             visitor.visit_finish_usage_example(None)
+            return expression
+        return None
 
     def _media_accept(self, note, keys, visitor):
         if self.sound_field is not None and self.sound_field in keys:
@@ -134,11 +216,18 @@ class AnkiWalker(object):
         return unicode(re.sub("(?i)\.(anki2)$", ".media", self.col.path))
 
 class AnkiImporterVisitor(AbstractCorpusImporterVisitor):
-    """Imports Anki deck using visitor pattern."""
+    """Imports Anki deck using visitor pattern.
+
+    Media files are added to the profile's MediaStore, which copies files
+    it does not have yet on a MediaCopier while the import goes on. The
+    usage examples refer to the stored files.
+    """
     def __init__(self, session, parser, pm):
         super(AnkiImporterVisitor, self).__init__(session, parser)
         self.pm = pm
         self.media_dir = None
+        self.media_store = pm.media_store(session)
+        self.media_copier = MediaCopier()
 
     def get_import_version(self):
         return __version__
@@ -146,23 +235,22 @@ class AnkiImporterVisitor(AbstractCorpusImporterVisitor):
     def visit_collection(self, col):
         self.media_dir = re.sub("(?i)\.(anki2)$", ".media", col.path)
 
-    def _copy_media(self, ue_obj):
-        if ue_obj.sound is not None:
-            file_path = os.path.join(self.media_dir, ue_obj.sound)
-            dest_path = os.path.join(self.pm.media_path(), ue_obj.sound)
-            try:
-                with open(file_path):
-                    shutil.copyfile(file_path, dest_path)
-            except IOError:
-               pass
-        if ue_obj.image is not None:
-            file_path = os.path.join(self.media_dir, ue_obj.image)
-            dest_path = os.path.join(self.pm.media_path(), ue_obj.image)
-            try:
-                with open(file_path):
-                    shutil.copyfile(file_path, dest_path)
-            except IOError:
-               pass
+    def visit_finish(self):
+        super(AnkiImporterVisitor, self).visit_finish()
+        self.media_copier.close()
+        logging.info('media: %s', self.media_copier.throughput())
+
+    def visit_sound(self, sound):
+        super(AnkiImporterVisitor, self).visit_sound(self._store_media(sound))
+
+    def visit_image(self, image):
+        super(AnkiImporterVisitor, self).visit_image(self._store_media(image))
+
+    def _store_media(self, file_name):
+        # Files missing from the collection keep their name
+        path = self.media_store.add(os.path.join(self.media_dir, file_name),
+                                    self.media_copier)
+        return path or file_name
 
 
 def create_anki_sync_visitor(session, parser, pm):
@@ -194,7 +282,7 @@ def main():
     #                         expression_field='Expression', meaning_field='Meaning')
     importer = AnkiWalker(collection_path, 'Core 2000 Japanese Vocabulary',
         expression_field='Sentence - Kanji', meaning_field='Sentence - English',
-        sound_field='Sentence - Audio')
+        sound_field='Sentence - Audio', direct_read=True)
     parser = JapaneseParser()
     visitor = create_anki_sync_visitor(session, parser, pm)
     print importer._get_media_folder_path()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError: # xz files are not supported
+        lzma = None
+
+def _gzip_decompressor():
+    # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _xz_decompressor():
+    if lzma is None:
+        raise Exception("reading .xz files needs the backports.lzma package")
+    return lzma.LZMADecompressor()
+
+DECOMPRESSORS = {'.gz': _gzip_decompressor,
+                 '.bz2': bz2.BZ2Decompressor,
+                 '.xz': _xz_decompressor,}
+
+class DecompressingReader(object):
+    """Read-only file object that decompresses another file object.
+
+    tell() returns the offset in the compressed file, so progress can be
+    reported against the size of the file on disk. Concatenated streams,
+    as written by pigz or pbzip2, are read one after another.
+    """
+    def __init__(self, raw, new_decompressor, chunk_size=1 << 16):
+        super(DecompressingReader, self).__init__()
+        self.raw = raw
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.position = 0 # of the next byte to return in buffer
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self._buffered() < size):
+            self._fill()
+        if size < 0:
+            size = self._buffered()
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        while not self.eof and self.buffer.find(b'\n', self.position) < 0:
+            self._fill()
+        end = self.buffer.find(b'\n', self.position) + 1 or len(self.buffer)
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.raw.close()
+
+    def _buffered(self):
+        return len(self.buffer) - self.position
+
+    def _fill(self):
+        chunk = self.raw.read(self.chunk_size)
+        data = b''
+        if not chunk:
+            if hasattr(self.decompressor, 'flush'):
+                data = self.decompressor.flush()
+            self.eof = True
+        else:
+            data = self._decompress(chunk)
+            # Data after the end of a stream is the start of the next stream
+            while self.decompressor.unused_data:
+                unused = self.decompressor.unused_data
+                self.decompressor = self.new_decompressor()
+                data += self._decompress(unused)
+        # Bytes already read are dropped once per chunk, not once per read
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+
+    def _decompress(self, data):
+        """Decompresses data, starting a new stream if the current one
+        ended exactly at the end of the previous chunk."""
+        if getattr(self.decompressor, 'eof', False):
+            self.decompressor = self.new_decompressor()
+        try:
+            return self.decompressor.decompress(data)
+        except EOFError:
+            # BZ2Decompressor has no eof attribute before Python 3.3
+            self.decompressor = self.new_decompressor()
+            return self.decompressor.decompress(data)
+
+def open_importable(path):
+    """Opens an importable for reading, decompressing it if needed.
+
+    The compression is chosen by the file extension (.gz, .bz2 or .xz).
+    """
+    raw = open(path, 'rb')
+    for extension, new_decompressor in DECOMPRESSORS.items():
+        if path.lower().endswith(extension):
+            return DecompressingReader(raw, new_decompressor)
+    return raw
@@ -3,8 +3,13 @@
 from __future__ import division
 import os
 import sys
+import hashlib
 import re
 import json
+import logging
+from collections import deque, defaultdict
+from copy import deepcopy
+from functools import partial
 from pyparsing import *
 from lxml import etree
 from textwrap import dedent
@@ -15,7 +20,17 @@ from noj.model import (
     db_constants,
 )
 from noj.tools.japanese_parser import JapaneseParser
-from noj.importers.abstract_importer import AbstractDictionaryImporterVisitor
+from noj.tools.memory_usage import peak_rss
+from noj.tools.parse_cache import ParseCache
+from noj.importers.abstract_importer import (
+    AbstractDictionaryImporterVisitor,
+    ReplaceImporterDecorator,
+)
+from noj.importers.import_writers import BufferedWriter
+from noj.importers.import_cache import ImporterCache
+from noj.importers.parse_pipeline import ParsePipeline
+from noj.importers.compressed_io import open_importable
+from noj.importers.staging import staged_import
 
 from noj.model.models import Session
 
@@ -26,72 +41,363 @@ pp = UniPrinter(indent=4)
 NAMESPACE_URI = "http://www.naturalorderjapanese.com"
 NAMESPACE_PREFIX = "{" + NAMESPACE_URI + "}"
 
+ENTRY_TAG           = NAMESPACE_PREFIX + 'entry'
+DICTIONARY_META_TAG = NAMESPACE_PREFIX + 'dictionary_meta'
+NAME_TAG            = NAMESPACE_PREFIX + 'name'
+DUMP_VERSION_TAG    = NAMESPACE_PREFIX + 'dump_version'
+CONVERT_VERSION_TAG = NAMESPACE_PREFIX + 'convert_version'
+DATE_TAG            = NAMESPACE_PREFIX + 'date'
+EXTRA_TAG           = NAMESPACE_PREFIX + 'extra'
+KANA_TAG            = NAMESPACE_PREFIX + 'kana'
+KANJI_TAG           = NAMESPACE_PREFIX + 'kanji'
+ACCENT_TAG          = NAMESPACE_PREFIX + 'accent'
+DEFINITION_TAG      = NAMESPACE_PREFIX + 'definition'
+DEFINITION_TEXT_TAG = NAMESPACE_PREFIX + 'definition_text'
+USAGE_EXAMPLE_TAG   = NAMESPACE_PREFIX + 'usage_example'
+EXPRESSION_TAG      = NAMESPACE_PREFIX + 'expression'
+READING_TAG         = NAMESPACE_PREFIX + 'reading'
+MEANING_TAG         = NAMESPACE_PREFIX + 'meaning'
+SOUND_TAG           = NAMESPACE_PREFIX + 'sound'
+IMAGE_TAG           = NAMESPACE_PREFIX + 'image'
+
+class RootValidator(object):
+    """Validates the root of a dictionary whose children are validated and
+    released one by one while it is parsed.
+
+    The tags of released children are recorded. validate() checks a
+    skeleton of the document against the schema: the root with its
+    attributes, and copies of the first validated entry and meta in place
+    of the children, with a run of entries as one entry.
+    """
+    def __init__(self, xmlschema):
+        super(RootValidator, self).__init__()
+        self.xmlschema = xmlschema
+        self.tags = list() # tags of the released children of the root
+        self.samples = dict() # tag -> copy of the first valid element
+
+    def validated(self, elem):
+        """Call after elem, an entry or the meta, passed validation."""
+        # Fail before anything is imported without a library, or into a
+        # second library
+        if elem.tag == DICTIONARY_META_TAG:
+            check_root = DICTIONARY_META_TAG in self.samples
+        else:
+            check_root = DICTIONARY_META_TAG not in self.samples
+        if elem.tag not in self.samples:
+            self.samples[elem.tag] = deepcopy(elem)
+        if check_root:
+            self.validate(elem.getroottree().getroot())
+
+    def released(self, tag):
+        if not (tag == ENTRY_TAG and self.tags and self.tags[-1] == ENTRY_TAG):
+            self.tags.append(tag)
+
+    def validate(self, root):
+        """Raises DocumentInvalid if the root is invalid."""
+        skeleton = etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+        last_tag = None
+        for tag in self.tags + [child.tag for child in root]:
+            if not isinstance(tag, basestring): # comments
+                continue
+            if tag == ENTRY_TAG and last_tag == ENTRY_TAG:
+                continue
+            if tag in self.samples:
+                skeleton.append(deepcopy(self.samples[tag]))
+            else:
+                skeleton.append(etree.Element(tag))
+            last_tag = tag
+        self.xmlschema.assertValid(skeleton)
+
 class DictionaryWalker(object):
-    """Import XML dictionary files into the database."""
-    def __init__(self, importable_path):
+    """Import XML dictionary files into the database.
+
+    If the visitor's parser has a prefetch method (e.g. a ParsePipeline),
+    the walker reads prefetch_entries entries ahead of the visitor and
+    submits their texts for parsing before visiting them.
+
+    If resumable is True, a checkpoint with the last visited entry and the
+    visitor's state is written in the same transaction as every periodic
+    commit, which happens every commit_every entries. The peak RSS of the
+    process is logged and stored in peak_rss at the same time. A later
+    import of the same file resumes after the checkpoint instead of
+    starting over: the file is parsed from the start and the entries up to
+    the checkpoint are skipped. The importer caches are not stored; they
+    are warmed again from the committed rows. The checkpoint records the
+    size and modification time of the file; if they changed, the file may
+    have other entries at the same numbers, so the partial library and its
+    checkpoint are deleted and the import starts over.
+
+    If schema_path is given, each entry is validated against the schema as
+    it is parsed, in the same pass as the import, and the root element is
+    checked with a RootValidator. The dictionary meta must come before the
+    first entry. If the document is invalid, the library imported so far
+    and its checkpoint are deleted before DocumentInvalid is raised. If
+    skip_validated is True, the content hash of a file that passed as a
+    whole is stored and validation is skipped when the same file is
+    imported again.
+
+    Importables ending in .gz, .bz2 or .xz are decompressed as they are
+    read. Progress offsets are positions in the compressed file, so they
+    stay comparable with len(walker).
+
+    Entries are numbered from first_entry_number, so a part of a dictionary
+    can be imported with the numbers it has in the whole dictionary.
+    """
+    def __init__(self, importable_path, prefetch_entries=256, resumable=True,
+                 commit_every=20000, schema_path=None, skip_validated=True,
+                 first_entry_number=1):
         super(DictionaryWalker, self).__init__()
         self.importable_path = importable_path
+        self.prefetch_entries = prefetch_entries
+        self.resumable = resumable
+        self.commit_every = commit_every
+        self.schema_path = schema_path
+        self.skip_validated = skip_validated
+        self.first_entry_number = first_entry_number
+        self.last_entry_number = None
+        self.last_offset = None
+        self.root_validator = None
 
     def __len__(self):
         return os.path.getsize(self.importable_path)
 
+    def open_importable(self):
+        """Returns a file object reading the XML of the importable."""
+        return open_importable(self.importable_path)
+
     def validate_schema(self, schema_path):
         xmlschema_doc = etree.parse(schema_path)
         xmlschema = etree.XMLSchema(xmlschema_doc)
 
         print 'parsing'
-        doc = etree.parse(self.importable_path) 
+        with self.open_importable() as f:
+            doc = etree.parse(f)
         print 'validating'
         # print xmlschema.validate(doc)
         xmlschema.assertValid(doc)
 
     def import_generator(self, visitor):
-        entry_tag = NAMESPACE_PREFIX + 'entry'
-        dictionary_meta_tag = NAMESPACE_PREFIX + 'dictionary_meta'
-        entry_number = 1
-
-        with open(self.importable_path, 'rb') as f:
-            context = etree.iterparse(f, tag=(entry_tag, dictionary_meta_tag))
-
-            for action, elem in context:
-                if elem.tag == entry_tag:
-                    entry_xml = elem
-                    self._entry_accept(entry_xml, visitor, entry_number)
-                    entry_number += 1
-                    yield f.tell()
-
-                elif elem.tag == dictionary_meta_tag:
-                    # Name
-                    name_xml = elem.find(NAMESPACE_PREFIX + 'name')
-                    visitor.visit_library(name_xml.text)
-
-                    # Dump version
-                    dump_version_xml = elem.find(NAMESPACE_PREFIX + 'dump_version')
-                    if dump_version_xml is not None:
-                        visitor.visit_library_dump_version(dump_version_xml.text)
-
-                    # Convert version
-                    convert_version_xml = elem.find(NAMESPACE_PREFIX + 'convert_version')
-                    if convert_version_xml is not None:
-                        visitor.visit_library_convert_version(convert_version_xml.text)
-
-                    # Date
-                    date_xml = elem.find(NAMESPACE_PREFIX + 'date')
-                    if date_xml is not None:
-                        visitor.visit_library_date(date_xml.text)
-
-                    # extra
-                    extra_text = self._get_extra_text(elem)
-                    if extra_text is not None:
-                        visitor.visit_library_extra(extra_text)
-
-                    visitor.visit_finish_library()
-
-                elem.clear()
-        visitor.visit_finish()
-
-    def _get_extra_text(self, elem):
-        extra_list = elem.findall(NAMESPACE_PREFIX + 'extra')
+        entry_number = self.first_entry_number
+
+        prefetch = getattr(visitor.parser, 'prefetch', None)
+        lookahead = self.prefetch_entries if prefetch is not None else 0
+        pending = deque() # (entry_xml, number, offset) not yet visited
+
+        checkpoint = None
+        if self.resumable:
+            checkpoint = self._load_checkpoint(visitor.session)
+        resume_after = 0
+        if checkpoint is not None:
+            visitor.visit_resume(json.loads(checkpoint.state))
+            resume_after = checkpoint.entry_number
+
+        xmlschema = None
+        hashes = None
+        if self.schema_path is not None:
+            if self.skip_validated:
+                hashes = {'content_hash': file_hash(self.importable_path),
+                          'schema_hash': file_hash(self.schema_path)}
+            if hashes is None or not self._was_validated(visitor.session, hashes):
+                xmlschema = etree.XMLSchema(etree.parse(self.schema_path))
+        self.root_validator = None
+        if xmlschema is not None:
+            self.root_validator = RootValidator(xmlschema)
+
+        self.last_entry_number = None
+        self.last_offset = None
+        self.peak_rss = None
+        try:
+            with db.bulk_load(visitor.session, self.commit_every) as loader:
+                loader.before_commit.append(self._report_progress)
+                if self.resumable:
+                    save_checkpoint = partial(self._save_checkpoint, visitor)
+                    loader.before_commit.append(save_checkpoint)
+
+                with self.open_importable() as f:
+                    context = etree.iterparse(f, tag=(ENTRY_TAG, DICTIONARY_META_TAG))
+
+                    for action, elem in context:
+                        if elem.tag == ENTRY_TAG and entry_number <= resume_after:
+                            # Already committed before the import was interrupted
+                            if xmlschema is not None and \
+                                    ENTRY_TAG not in self.root_validator.samples:
+                                # The root is checked with a valid entry
+                                xmlschema.assertValid(elem)
+                                self.root_validator.validated(elem)
+                            entry_number += 1
+                            self._release(elem)
+                            yield f.tell()
+
+                        elif elem.tag == ENTRY_TAG:
+                            if xmlschema is not None:
+                                xmlschema.assertValid(elem)
+                                self.root_validator.validated(elem)
+                            if prefetch is not None:
+                                prefetch(self._get_parse_texts(elem))
+                            pending.append((elem, entry_number, f.tell()))
+                            entry_number += 1
+                            while len(pending) > lookahead:
+                                yield self._pending_entry_accept(pending, visitor, loader)
+
+                        elif elem.tag == DICTIONARY_META_TAG:
+                            if xmlschema is not None:
+                                xmlschema.assertValid(elem)
+                                self.root_validator.validated(elem)
+                            if checkpoint is None:
+                                self._dictionary_meta_accept(elem, visitor)
+                            elem.clear()
+
+                    if xmlschema is not None:
+                        self.root_validator.validate(context.root)
+                    while pending:
+                        yield self._pending_entry_accept(pending, visitor, loader)
+                visitor.visit_finish()
+
+                if xmlschema is not None and hashes is not None:
+                    db.insert(visitor.session, models.ValidatedImportable, **hashes)
+
+                # The import is complete, so the last commit removes the checkpoint
+                if self.resumable:
+                    loader.before_commit.remove(save_checkpoint)
+                    self._delete_checkpoint(visitor.session)
+        except etree.DocumentInvalid:
+            # Resuming would stop at the same entry again, so start over
+            self._delete_partial_import(visitor.session, visitor.lib_id)
+            raise
+
+    def _report_progress(self):
+        self.peak_rss = peak_rss()
+        if self.peak_rss is not None:
+            logging.info('imported %s entries, peak RSS %.1f MiB',
+                         self.last_entry_number, self.peak_rss / (1 << 20))
+
+    def _was_validated(self, session, hashes):
+        return session.query(models.ValidatedImportable).filter_by(**hashes).\
+            first() is not None
+
+    def _importable_key(self):
+        return os.path.abspath(self.importable_path)
+
+    def _importable_stat(self):
+        stat = os.stat(self.importable_path)
+        return {'importable_size': stat.st_size,
+                'importable_mtime': stat.st_mtime}
+
+    def _load_checkpoint(self, session):
+        checkpoint = session.query(models.ImportCheckpoint).\
+            filter(models.ImportCheckpoint.importable==self._importable_key()).\
+            first()
+        if checkpoint is None:
+            return None
+        stat = self._importable_stat()
+        if (checkpoint.importable_size != stat['importable_size'] or
+            checkpoint.importable_mtime != stat['importable_mtime']):
+            logging.warning('%s changed since the import checkpoint, '
+                            'starting over', self.importable_path)
+            self._delete_partial_import(session, checkpoint.library_id)
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, visitor):
+        state = visitor.visit_checkpoint()
+        if self.last_entry_number is not None:
+            db.insert_or_replace(visitor.session, models.ImportCheckpoint,
+                                 importable=self._importable_key(),
+                                 library_id=state['lib_id'],
+                                 entry_number=self.last_entry_number,
+                                 byte_offset=self.last_offset,
+                                 state=json.dumps(state),
+                                 **self._importable_stat())
+
+    def _delete_checkpoint(self, session):
+        checkpoints = models.ImportCheckpoint.__table__
+        session.execute(checkpoints.delete().where(
+            checkpoints.c.importable==self._importable_key()))
+
+    def _delete_partial_import(self, session, lib_id):
+        if lib_id is not None:
+            db.delete_library(session, lib_id)
+        self._delete_checkpoint(session)
+        session.commit()
+
+    def _dictionary_meta_accept(self, meta_xml, visitor):
+        children = self._children_by_tag(meta_xml)
+
+        # Name
+        name_xml = _first(children[NAME_TAG])
+        visitor.visit_library(name_xml.text)
+
+        # Dump version
+        dump_version_xml = _first(children[DUMP_VERSION_TAG])
+        if dump_version_xml is not None:
+            visitor.visit_library_dump_version(dump_version_xml.text)
+
+        # Convert version
+        convert_version_xml = _first(children[CONVERT_VERSION_TAG])
+        if convert_version_xml is not None:
+            visitor.visit_library_convert_version(convert_version_xml.text)
+
+        # Date
+        date_xml = _first(children[DATE_TAG])
+        if date_xml is not None:
+            visitor.visit_library_date(date_xml.text)
+
+        # extra
+        extra_text = self._get_extra_text(children[EXTRA_TAG])
+        if extra_text is not None:
+            visitor.visit_library_extra(extra_text)
+
+        visitor.visit_finish_library()
+
+    def _pending_entry_accept(self, pending, visitor, loader):
+        entry_xml, number, offset = pending.popleft()
+        self._entry_accept(entry_xml, visitor, number)
+        visitor.visit_finish_entry()
+        self.last_entry_number = number
+        self.last_offset = offset
+        loader.step()
+        self._release(entry_xml)
+        return offset
+
+    def _release(self, elem):
+        """Frees a visited element and the visited siblings before it.
+
+        Clearing an element leaves an empty node attached to the root, so
+        without removing them the tree would still grow with every entry.
+        """
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                if self.root_validator is not None:
+                    self.root_validator.released(parent[0].tag)
+                del parent[0]
+
+    def _get_parse_texts(self, entry_xml):
+        """Returns the texts the visitor will parse, in visiting order."""
+        # The schema puts definition texts before usage examples and
+        # subdefinitions, so document order is visiting order
+        root_def_xml = _first(entry_xml.iterchildren(DEFINITION_TAG))
+        if entry_xml.get('format') == 'J-J1':
+            text_elems = root_def_xml.iter(DEFINITION_TEXT_TAG, EXPRESSION_TAG)
+        else:
+            text_elems = root_def_xml.iter(EXPRESSION_TAG)
+        texts = list()
+        for text_xml in text_elems:
+            if text_xml.tag == EXPRESSION_TAG:
+                texts.append(text_xml.text or '')
+            elif text_xml.text is not None:
+                texts.append(text_xml.text)
+        return texts
+
+    def _children_by_tag(self, elem):
+        """Groups the children of elem by tag in a single pass."""
+        children = defaultdict(list)
+        for child in elem:
+            children[child.tag].append(child)
+        return children
+
+    def _get_extra_text(self, extra_list):
         extra_dict = dict()
         for extra_xml in extra_list:
             extra_name = extra_xml.get('name')
@@ -101,37 +407,30 @@ class DictionaryWalker(object):
         return None
 
     def _entry_accept(self, entry_xml, visitor, number):
+        children = self._children_by_tag(entry_xml)
         visitor.visit_entry(number)
 
         # Import entry format
         self.eformat = entry_xml.get('format') or 'J-E1'
         visitor.visit_entry_format(self.eformat)
 
-        # Import kana raw
-        if self.eformat == 'J-J1':
-            kana_list = entry_xml.findall(NAMESPACE_PREFIX + 'kana')
-            kana_raw_list = list()
-            for kana_xml in kana_list:
-                kana_raw_list.append(kana_xml.text)
-            if kana_raw_list:
-                visitor.visit_kana_raw_list(kana_raw_list)
-
-        # Import kanji raw
+        kana_list = [kana_xml.text for kana_xml in children[KANA_TAG]]
+        kanji_list = [kanji_xml.text for kanji_xml in children[KANJI_TAG]]
+
+        # Import kana raw and kanji raw
         if self.eformat == 'J-J1':
-            kanji_list = entry_xml.findall(NAMESPACE_PREFIX + 'kanji')
-            kanji_raw_list = list()
-            for kanji_xml in kanji_list:
-                kanji_raw_list.append(kanji_xml.text)
-            if kanji_raw_list:
-                visitor.visit_kanji_raw_list(kanji_raw_list)
+            if kana_list:
+                visitor.visit_kana_raw_list(kana_list)
+            if kanji_list:
+                visitor.visit_kanji_raw_list(kanji_list)
 
         # Import accent
-        accent_xml = entry_xml.find(NAMESPACE_PREFIX + 'accent')
+        accent_xml = _first(children[ACCENT_TAG])
         if accent_xml is not None:
             visitor.visit_accent(accent_xml.text)
 
         # Import extra
-        extra_text = self._get_extra_text(entry_xml)
+        extra_text = self._get_extra_text(children[EXTRA_TAG])
         if extra_text is not None:
             visitor.visit_entry_extra(extra_text)
 
@@ -139,22 +438,19 @@ class DictionaryWalker(object):
         visitor.visit_construct_entry()
 
         # Import kana
-        kana_list_xml = entry_xml.findall(NAMESPACE_PREFIX + 'kana')
-        kana_list = [kana_xml.text for kana_xml in kana_list_xml]
         if kana_list:
             visitor.visit_kana_list(kana_list)
 
         # Import kanji
-        kanji_list_xml = entry_xml.findall(NAMESPACE_PREFIX + 'kanji')
-        kanji_list = [kanji_xml.text for kanji_xml in kanji_list_xml]
         if kanji_list:
             visitor.visit_kanji_list(kanji_list)
 
         # Import definitions
-        root_def_xml = entry_xml.find(NAMESPACE_PREFIX + 'definition')
+        root_def_xml = _first(children[DEFINITION_TAG])
         self._definition_accept(root_def_xml, 1, visitor)
 
     def _definition_accept(self, definition_xml, number, visitor):
+        children = self._children_by_tag(definition_xml)
         visitor.visit_definition(number)
 
         group = definition_xml.get('group')
@@ -162,14 +458,12 @@ class DictionaryWalker(object):
             visitor.visit_definition_group(group)
 
         # Import definition text
-        def_text_xml = definition_xml.find(NAMESPACE_PREFIX + 'definition_text')
-        def_text = None
+        def_text_xml = _first(children[DEFINITION_TEXT_TAG])
         if def_text_xml is not None:
-            def_text = def_text_xml.text
-            visitor.visit_definition_text(def_text)
+            visitor.visit_definition_text(def_text_xml.text)
 
         # Import extra
-        extra_text = self._get_extra_text(definition_xml)
+        extra_text = self._get_extra_text(children[EXTRA_TAG])
         if extra_text is not None:
             visitor.visit_definition_extra(extra_text)
 
@@ -177,50 +471,49 @@ class DictionaryWalker(object):
         visitor.visit_construct_definition()
 
         # Import usage examples
-        ue_list = definition_xml.findall(NAMESPACE_PREFIX + 'usage_example')
-        for i, ue_xml in enumerate(ue_list):
+        for i, ue_xml in enumerate(children[USAGE_EXAMPLE_TAG]):
             self._usage_example_accept(ue_xml, i+1, visitor)
 
         # Import definition to usage example association
         visitor.visit_finish_definition_ues()
 
         # Import subdefinitions
-        subdefinition_list = definition_xml.findall(NAMESPACE_PREFIX + 'definition')
-        for i, subdef_xml in enumerate(subdefinition_list):
+        for i, subdef_xml in enumerate(children[DEFINITION_TAG]):
             self._definition_accept(subdef_xml, i+1, visitor)
 
         visitor.visit_finish_definition()
 
     def _usage_example_accept(self, usage_example_xml, number, visitor):
+        children = self._children_by_tag(usage_example_xml)
         ue_type = usage_example_xml.get('type') or 'UNKNOWN'
         visitor.visit_usage_example(ue_type)
 
         # Import expression
-        expression_xml = usage_example_xml.find(NAMESPACE_PREFIX + 'expression')
+        expression_xml = _first(children[EXPRESSION_TAG])
         visitor.visit_expression(expression_xml.text)
 
         # Import reading
-        reading_xml = usage_example_xml.find(NAMESPACE_PREFIX + 'reading')
+        reading_xml = _first(children[READING_TAG])
         if reading_xml is not None:
             visitor.visit_ue_reading(reading_xml.text)
 
         # Import meaning
-        meaning_xml = usage_example_xml.find(NAMESPACE_PREFIX + 'meaning')
+        meaning_xml = _first(children[MEANING_TAG])
         if meaning_xml is not None:
             visitor.visit_meaning(meaning_xml.text)
 
         # Import sound
-        sound_xml = usage_example_xml.find(NAMESPACE_PREFIX + 'sound')
+        sound_xml = _first(children[SOUND_TAG])
         if sound_xml is not None:
             visitor.visit_sound(sound_xml.text)
 
         # Import image
-        image_xml = usage_example_xml.find(NAMESPACE_PREFIX + 'image')
+        image_xml = _first(children[IMAGE_TAG])
         if image_xml is not None:
             visitor.visit_image(image_xml.text)
 
         # Import extra
-        extra_text = self._get_extra_text(usage_example_xml)
+        extra_text = self._get_extra_text(children[EXTRA_TAG])
         if extra_text is not None:
             visitor.visit_ue_extra(extra_text)
 
@@ -236,10 +529,37 @@ class DictionaryWalker(object):
         visitor.visit_finish_usage_example(number)
 
 
+def _first(elems):
+    """Returns the first element of elems or None."""
+    for elem in elems:
+        return elem
+    return None
+
+def file_hash(path):
+    """Returns the SHA-1 hex digest of a file's content."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 class DictionaryImporterVisitor(AbstractDictionaryImporterVisitor):
-    """docstring for DictionaryImporterVisitor"""
-    def __init__(self, session, parser):
-        super(DictionaryImporterVisitor, self).__init__(session, parser)
+    """Imports a dictionary using the visitor pattern.
+
+    If buffered is True, rows are accumulated in memory and written in
+    batches by a BufferedWriter instead of one statement per row. If
+    warm_cache is True, the ids already in the database are loaded into
+    the importer cache before the import starts. If parse_cache is given,
+    texts found in the ParseCache are not parsed again.
+    """
+    def __init__(self, session, parser, buffered=False, warm_cache=True,
+                 parse_cache=None):
+        cache = ImporterCache()
+        if warm_cache:
+            cache.warm(session)
+        writer = BufferedWriter(session, cache=cache) if buffered else None
+        super(DictionaryImporterVisitor, self).__init__(session, parser, writer,
+                                                        cache, parse_cache)
 
     def get_import_version(self):
         return __version__
@@ -254,24 +574,52 @@ def main():
     #importable_path = '../converters/jmdict/jmdict-importable.xml'
     importable_path = sys.argv[1]
     # importable_path = '../../schemas/example_dictionary_1.0.0a.xml'
+    # Import into a staging database and merge it at the end, so the
+    # database is only locked while merging
+    staged = '--staged' in sys.argv[2:]
 
     import progressbar as pb
     widgets = ['Importing: ', pb.Percentage(), ' ', pb.Bar(),
                ' ', pb.Timer(), ' ']
 
     session = Session()
-    importer = DictionaryWalker(importable_path)
-    parser = JapaneseParser()
-    visitor = DictionaryImporterVisitor(session, parser)
-    importer.validate_schema(schema_path)
-
-    pbar = pb.ProgressBar(widgets=widgets, maxval=len(importer)).start()
-    for i in importer.import_generator(visitor):
-        pbar.update(i)
+    # A staging database is new for every import, so there is no resuming
+    importer = DictionaryWalker(importable_path, resumable=not staged,
+                                schema_path=schema_path)
+    parse_cache = ParseCache('../../parse_cache.sqlite',
+                             JapaneseParser().dictionary_identity())
+    parser = ParsePipeline(parse_cache=parse_cache)
+
+    def run_import(import_session):
+        visitor = DictionaryImporterVisitor(import_session, parser,
+                                            buffered=True,
+                                            parse_cache=parse_cache)
+        # Importing a dictionary again replaces it
+        visitor = ReplaceImporterDecorator(visitor, session)
+        pbar = pb.ProgressBar(widgets=widgets, maxval=len(importer)).start()
+        for i in importer.import_generator(visitor):
+            pbar.update(i)
+        return visitor, pbar
+
+    if staged:
+        # The replaced libraries are deleted by the merge, so they are kept
+        # if the import fails
+        replaced = list()
+        with staged_import(session, replace_library_ids=replaced) as \
+                staging_session:
+            visitor, pbar = run_import(staging_session)
+            replaced.extend(visitor.replaced_library_ids)
+        db.collect_garbage(session)
+    else:
+        visitor, pbar = run_import(session)
 
     session.commit()
     session.close()
+    parser.close()
+    parse_cache.close()
     pbar.finish()
+    if importer.peak_rss is not None:
+        print 'peak RSS: {:.1f} MiB'.format(importer.peak_rss / (1 << 20))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from sqlalchemy.sql import select
+from noj.model import models
+
+
+class IdCache(object):
+    """Bounded map from unicode keys to row ids.
+
+    Keys are kept as UTF-8 byte strings, which take far less memory than
+    unicode objects or tuples, so millions of keys fit in memory. When the
+    cache is full an arbitrary key is evicted; a miss only means the caller
+    has to ask the database.
+    """
+    def __init__(self, max_keys):
+        super(IdCache, self).__init__()
+        self.max_keys = max_keys
+        self.ids = dict()
+        self.evicted = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, key):
+        return self.ids.get(key.encode('utf-8'))
+
+    def set(self, key, id_):
+        if len(self.ids) >= self.max_keys:
+            self.ids.popitem()
+            self.evicted = True
+        self.ids[key.encode('utf-8')] = id_
+
+class ImporterCache(object):
+    """Resolves morphemes, expressions, usage example types and entry
+    formats to ids in memory during an import.
+
+    warm() preloads the ids already in the database, up to max_keys per
+    table. Once warmed, covers() tells whether a miss means the row is not
+    in the database.
+    """
+    def __init__(self, max_keys=5000000):
+        super(ImporterCache, self).__init__()
+        self.max_keys = max_keys
+        self.morphemes = IdCache(max_keys)
+        self.expressions = IdCache(max_keys)
+        self.ue_types = IdCache(max_keys)
+        self.entry_formats = IdCache(max_keys)
+        self.complete = dict()  # table name -> IdCache holding all its keys
+
+    def warm(self, session):
+        morphemes = models.Morpheme.__table__
+        s = select([morphemes.c.id, morphemes.c.morpheme, morphemes.c.type_id])
+        num_rows = 0
+        for row in session.execute(s.limit(self.max_keys)):
+            self.set_morpheme(row.morpheme, row.type_id, row.id)
+            num_rows += 1
+        self._warmed(morphemes, self.morphemes, num_rows)
+
+        expressions = models.Expression.__table__
+        s = select([expressions.c.id, expressions.c.expression])
+        num_rows = 0
+        for row in session.execute(s.limit(self.max_keys)):
+            self.expressions.set(row.expression, row.id)
+            num_rows += 1
+        self._warmed(expressions, self.expressions, num_rows)
+
+        for orm_class, cache in ((models.UEType, self.ue_types),
+                                 (models.EntryFormat, self.entry_formats)):
+            table = orm_class.__table__
+            s = select([table.c.id, table.c.name])
+            num_rows = 0
+            for row in session.execute(s.limit(self.max_keys)):
+                cache.set(row.name, row.id)
+                num_rows += 1
+            self._warmed(table, cache, num_rows)
+
+    def covers(self, table_name):
+        """True if every key of the table is cached, so a miss is a new
+        row. Holds as long as all rows are added through the cache."""
+        cache = self.complete.get(table_name)
+        return cache is not None and not cache.evicted
+
+    def replace(self, table_name, key, old_id, new_id):
+        """Points a cached key of a row of the table, by its unique fields,
+        from old_id to new_id."""
+        if table_name == models.Morpheme.__tablename__:
+            cache, cache_key = self.morphemes, self._morpheme_key(*key)
+        else:
+            cache = {models.Expression.__tablename__: self.expressions,
+                     models.UEType.__tablename__: self.ue_types,
+                     models.EntryFormat.__tablename__: self.entry_formats}.\
+                get(table_name)
+            if cache is None:
+                return
+            cache_key = key[0]
+        if cache.get(cache_key) == old_id:
+            cache.set(cache_key, new_id)
+
+    def _warmed(self, table, cache, num_rows):
+        if num_rows < self.max_keys:
+            self.complete[table.name] = cache
+
+    def get_morpheme(self, morpheme, type_id):
+        return self.morphemes.get(self._morpheme_key(morpheme, type_id))
+
+    def set_morpheme(self, morpheme, type_id, id_):
+        self.morphemes.set(self._morpheme_key(morpheme, type_id), id_)
+
+    def _morpheme_key(self, morpheme, type_id):
+        return u'{}\t{}'.format(type_id, morpheme)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from sqlalchemy.sql import and_, select, func
+from noj.model import db, models
+
+
+class DirectWriter(object):
+    """Writes each visited row to the database straight away."""
+    def __init__(self, session):
+        super(DirectWriter, self).__init__()
+        self.session = session
+
+    def insert(self, orm_class, **kwargs):
+        return db.insert(self.session, orm_class, **kwargs)
+
+    def insert_orm(self, orm_obj):
+        return db.insert_orm(self.session, orm_obj)
+
+    def insert_many(self, orm_class, tuples):
+        db.insert_many(self.session, orm_class, tuples)
+
+    def when_new(self, orm_class, id_, callback):
+        callback()
+
+    def entry_finished(self):
+        pass
+
+    def flush(self):
+        pass
+
+# A row whose unique key refers to a row of these tables that the writer
+# created cannot be in the database yet
+NEW_PARENT_TABLES = [models.Library.__table__]
+
+class BufferedWriter(object):
+    """Accumulates rows in memory and writes each table with one executemany.
+
+    Primary keys are assigned by the writer rather than by SQLite, so rows
+    can be referenced by their children before they are flushed. Rows are
+    flushed every flush_entries entries and when flush() is called.
+
+    Unique keys are resolved in memory where possible: from the rows the
+    writer buffered, and from cache, an ImporterCache whose misses are new
+    rows if it holds every key of a table. Other rows are looked up in
+    batches when they are flushed, and dropped if they already exist, with
+    the rows referring to them remapped and cache pointed at the existing
+    rows. The ids of dropped rows are not valid after the flush, so callers
+    keep ids of such rows in cache.
+    """
+    EXECUTE_ROWS = 50000  # rows turned back into dicts at a time
+
+    def __init__(self, session, flush_entries=5000, cache=None):
+        super(BufferedWriter, self).__init__()
+        self.session = session
+        self.flush_entries = flush_entries
+        self.cache = cache
+        self.num_entries = 0
+        self.next_ids = dict()        # table -> next free primary key
+        self.pending = OrderedDict()  # (table, columns, ignore) -> tuples
+        # table -> {unique key without its last field -> {last field -> id}}
+        self.pending_keys = dict()    # rows buffered since the last flush
+        self.created_keys = dict()    # rows under a parent the writer created
+        self.new_ids = dict()         # table in NEW_PARENT_TABLES -> ids
+        self.candidates = dict()      # table -> (unique fields, {key -> id})
+        self.remaps = dict()          # table -> {buffered id -> existing id}
+        self.unique_fields = dict()   # table -> unique fields
+        self.new_created_keys = list() # (table, key) created since the flush
+        self.callbacks = list()       # (table, id, callback) for when_new
+
+    def insert(self, orm_class, **kwargs):
+        """Buffers a row, returns (id, new) like db.insert.
+
+        A row that may be in the database already is only looked up when it
+        is flushed, and new is None; pass a callback to when_new for what
+        to do if it is new. If it exists, it is dropped and its id is
+        remapped to the existing row's.
+        """
+        table = orm_class.__table__
+        unique_fields = getattr(orm_class, 'unique_fields', None)
+        if unique_fields:
+            self.unique_fields[table] = unique_fields
+            key = tuple(kwargs[f] for f in unique_fields)
+            under_new_parent = self._has_new_parent(table, unique_fields, kwargs)
+            keys = self.created_keys if under_new_parent else self.pending_keys
+            keys = keys.setdefault(table, dict()).setdefault(key[:-1], dict())
+            if key[-1] in keys:
+                return (keys[key[-1]], False)
+
+        if kwargs.get('id') is None:
+            kwargs['id'] = self._next_id(table)
+        self._buffer(table, kwargs, False)
+        if table in NEW_PARENT_TABLES:
+            self.new_ids.setdefault(table, set()).add(kwargs['id'])
+        if unique_fields:
+            keys[key[-1]] = kwargs['id']
+            if under_new_parent:
+                self.new_created_keys.append((table, key))
+            elif not (self.cache is not None and self.cache.covers(table.name)):
+                fields, candidates = self.candidates.setdefault(table,
+                    (unique_fields, dict()))
+                candidates[key] = kwargs['id']
+                return (kwargs['id'], None)
+        return (kwargs['id'], True)
+
+    def insert_orm(self, orm_obj):
+        d = dict()
+        for c in orm_obj.__table__.columns:
+            if c.key in orm_obj.__dict__:
+                d[c.key] = orm_obj.__dict__[c.key]
+        return self.insert(orm_obj.__class__, **d)
+
+    def insert_many(self, orm_class, tuples):
+        for row in tuples:
+            self._buffer(orm_class.__table__, row, True)
+
+    def when_new(self, orm_class, id_, callback):
+        """Calls callback at the next flush if the row with id_, inserted
+        with new None, is not in the database."""
+        self.callbacks.append((orm_class.__table__, id_, callback))
+
+    def entry_finished(self):
+        self.num_entries += 1
+        if self.num_entries % self.flush_entries == 0:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows, one executemany per table."""
+        # Callbacks can buffer more rows to look up
+        while self.candidates or self.callbacks:
+            self._resolve_candidates()
+            callbacks, self.callbacks = self.callbacks, list()
+            for table, id_, callback in callbacks:
+                if id_ not in self.remaps.get(table, ()):
+                    callback()
+        self._remap_created_keys()
+        for (table, columns, ignore), rows in self.pending.items():
+            inserter = table.insert()
+            if ignore:
+                inserter = inserter.prefix_with('OR IGNORE')
+            for i in range(0, len(rows), self.EXECUTE_ROWS):
+                chunk = [dict(zip(columns, row))
+                         for row in rows[i:i+self.EXECUTE_ROWS]]
+                chunk = self._remap_rows(table, chunk)
+                if chunk:
+                    self.session.execute(inserter, chunk)
+        self.pending.clear()
+        # Flushed rows are candidates again if they are inserted again
+        self.pending_keys.clear()
+        # Nothing refers to the dropped rows any more
+        self.remaps.clear()
+
+    def _has_new_parent(self, table, unique_fields, row):
+        for f in unique_fields:
+            for fk in table.c[f].foreign_keys:
+                if row[f] in self.new_ids.get(fk.column.table, ()):
+                    return True
+        return False
+
+    def _resolve_candidates(self):
+        """Looks up the candidate rows in the database, in batches, and
+        remaps the ids of those that exist."""
+        # Parents first, so keys can refer to parents that turned out to exist
+        for table in models.Base.metadata.sorted_tables:
+            if table not in self.candidates:
+                continue
+            fields, candidates = self.candidates.pop(table)
+            key_remaps = [self._fk_remap(table.c[f]) for f in fields]
+            keys = dict()
+            for key, id_ in candidates.items():
+                keys[tuple(remap.get(v, v) for remap, v in
+                           zip(key_remaps, key))] = id_
+            # Batch on the field with the most distinct values
+            n = max(range(len(fields)),
+                    key=lambda i: len(set(key[i] for key in keys)))
+            batches = dict()
+            for key, id_ in keys.items():
+                prefix = key[:n] + key[n+1:]
+                batches.setdefault(prefix, dict())[key[n]] = id_
+            remap = self.remaps.setdefault(table, dict())
+            other_fields = fields[:n] + fields[n+1:]
+            for prefix, ids in batches.items():
+                values = list(ids)
+                for i in range(0, len(values), db.MAX_SQL_VARIABLES):
+                    whereclauses = [table.c[f]==v for f, v in
+                                    zip(other_fields, prefix)]
+                    whereclauses.append(table.c[fields[n]].in_(
+                        values[i:i+db.MAX_SQL_VARIABLES]))
+                    s = select([table.c.id, table.c[fields[n]]],
+                               and_(*whereclauses))
+                    for existing_id, value in self.session.execute(s):
+                        remap[ids[value]] = existing_id
+            if self.cache is not None:
+                for key, id_ in keys.items():
+                    if id_ in remap:
+                        self.cache.replace(table.name, key, id_, remap[id_])
+
+    def _remap_created_keys(self):
+        """Points the keys created since the last flush that refer to
+        dropped rows at the existing rows."""
+        for table, key in self.new_created_keys:
+            key_remaps = [self._fk_remap(table.c[f])
+                          for f in self.unique_fields[table]]
+            remapped = tuple(remap.get(v, v) for remap, v in zip(key_remaps, key))
+            if remapped != key:
+                keys = self.created_keys[table]
+                id_ = keys[key[:-1]].pop(key[-1])
+                keys.setdefault(remapped[:-1], dict())[remapped[-1]] = id_
+        del self.new_created_keys[:]
+
+    def _fk_remap(self, column):
+        for fk in column.foreign_keys:
+            return self.remaps.get(fk.column.table, dict())
+        return dict()
+
+    def _remap_rows(self, table, rows):
+        """Drops rows that already exist and points references to them at
+        the existing rows."""
+        dropped = self.remaps.get(table, dict())
+        references = [(c.name, self._fk_remap(c)) for c in table.columns]
+        references = [(name, remap) for name, remap in references if remap]
+        if not dropped and not references:
+            return rows
+        result = list()
+        for row in rows:
+            if row.get('id') in dropped:
+                continue
+            for name, remap in references:
+                if row.get(name) in remap:
+                    row[name] = remap[row[name]]
+            result.append(row)
+        return result
+
+    def _buffer(self, table, row, ignore):
+        # executemany needs every row to have the same columns. Rows are
+        # kept as tuples, which take a fraction of the memory of dicts.
+        columns = tuple(sorted(row))
+        group = (table, columns, ignore)
+        self.pending.setdefault(group, list()).append(
+            tuple(row[c] for c in columns))
+
+    def _next_id(self, table):
+        if table not in self.next_ids:
+            s = select([func.max(table.c.id)])
+            self.next_ids[table] = (self.session.execute(s).scalar() or 0) + 1
+        id_ = self.next_ids[table]
+        self.next_ids[table] = id_ + 1
+        return id_
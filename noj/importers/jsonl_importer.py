@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import json
+from collections import deque
+from lxml import etree
+from noj.model import db
+from noj.importers.compressed_io import open_importable
+from noj.importers.dictionary_importer import (
+    DictionaryWalker,
+    DictionaryImporterVisitor,
+    ENTRY_TAG,
+    DICTIONARY_META_TAG,
+)
+from noj.importers.parse_pipeline import ParsePipeline
+from noj.tools.japanese_parser import JapaneseParser
+from noj.tools.parse_cache import ParseCache
+
+try:
+    import msgpack
+except ImportError: # MessagePack importables are not supported
+    msgpack = None
+
+from noj.model.models import Session
+
+__version__ = '1.0.0a'
+
+MSGPACK_EXTENSIONS = ('.msgpack', '.mpk')
+
+def _is_msgpack(path):
+    return path.lower().endswith(MSGPACK_EXTENSIONS)
+
+def _json_extra(extra):
+    if extra:
+        return json.dumps(extra)
+    return None
+
+class JsonLinesWalker(object):
+    """Imports line-delimited dictionary files into the database.
+
+    The file holds one record per line: a dictionary_meta record followed
+    by one entry record per entry, each mirroring the tree of the XML
+    format, e.g.
+
+        {"dictionary_meta": {"name": ..., "date": ..., "extra": {...}}}
+        {"entry": {"format": "J-E1", "kana": [...], "kanji": [...],
+                   "definition": {"text": ..., "usage_examples": [...],
+                                  "definitions": [...]}}}
+
+    Files ending in .msgpack or .mpk hold the same records encoded with
+    MessagePack instead of JSON, which needs the msgpack package. Either
+    kind may be compressed like XML importables. The records are visited
+    in the same order as DictionaryWalker visits the XML, so any dictionary
+    visitor can be used. Use convert_xml_to_jsonl() to convert an XML
+    importable.
+    """
+    def __init__(self, importable_path, prefetch_entries=256,
+                 commit_every=20000):
+        super(JsonLinesWalker, self).__init__()
+        self.importable_path = importable_path
+        self.prefetch_entries = prefetch_entries
+        self.commit_every = commit_every
+
+    def __len__(self):
+        return os.path.getsize(self.importable_path)
+
+    def import_generator(self, visitor):
+        entry_number = 1
+
+        prefetch = getattr(visitor.parser, 'prefetch', None)
+        lookahead = self.prefetch_entries if prefetch is not None else 0
+        pending = deque() # (entry, number, offset) not yet visited
+
+        with db.bulk_load(visitor.session, self.commit_every) as loader:
+            with open_importable(self.importable_path) as f:
+                for record in self._records(f):
+                    if 'entry' in record:
+                        entry = record['entry']
+                        if prefetch is not None:
+                            prefetch(self._get_parse_texts(entry))
+                        pending.append((entry, entry_number, f.tell()))
+                        entry_number += 1
+                        while len(pending) > lookahead:
+                            yield self._pending_entry_accept(pending, visitor,
+                                                             loader)
+
+                    elif 'dictionary_meta' in record:
+                        self._dictionary_meta_accept(record['dictionary_meta'],
+                                                     visitor)
+
+                while pending:
+                    yield self._pending_entry_accept(pending, visitor, loader)
+            visitor.visit_finish()
+
+    def _records(self, f):
+        if _is_msgpack(self.importable_path):
+            if msgpack is None:
+                raise Exception("reading MessagePack importables needs the "
+                                "msgpack package")
+            return msgpack.Unpacker(f, raw=False)
+        return (json.loads(line) for line in iter(f.readline, b'')
+                if line.strip())
+
+    def _pending_entry_accept(self, pending, visitor, loader):
+        entry, number, offset = pending.popleft()
+        self._entry_accept(entry, visitor, number)
+        visitor.visit_finish_entry()
+        loader.step()
+        return offset
+
+    def _get_parse_texts(self, entry):
+        """Returns the texts the visitor will parse, in visiting order."""
+        texts = list()
+        self._add_parse_texts(entry['definition'],
+                              entry.get('format') == 'J-J1', texts)
+        return texts
+
+    def _add_parse_texts(self, definition, with_text, texts):
+        if with_text and definition.get('text') is not None:
+            texts.append(definition['text'])
+        for ue in definition.get('usage_examples', ()):
+            texts.append(ue.get('expression') or '')
+        for subdef in definition.get('definitions', ()):
+            self._add_parse_texts(subdef, with_text, texts)
+
+    def _dictionary_meta_accept(self, meta, visitor):
+        visitor.visit_library(meta['name'])
+        if meta.get('dump_version') is not None:
+            visitor.visit_library_dump_version(meta['dump_version'])
+        if meta.get('convert_version') is not None:
+            visitor.visit_library_convert_version(meta['convert_version'])
+        if meta.get('date') is not None:
+            visitor.visit_library_date(meta['date'])
+        extra_text = _json_extra(meta.get('extra'))
+        if extra_text is not None:
+            visitor.visit_library_extra(extra_text)
+        visitor.visit_finish_library()
+
+    def _entry_accept(self, entry, visitor, number):
+        visitor.visit_entry(number)
+
+        eformat = entry.get('format') or 'J-E1'
+        visitor.visit_entry_format(eformat)
+
+        kana_list = entry.get('kana', [])
+        kanji_list = entry.get('kanji', [])
+
+        if eformat == 'J-J1':
+            if kana_list:
+                visitor.visit_kana_raw_list(kana_list)
+            if kanji_list:
+                visitor.visit_kanji_raw_list(kanji_list)
+
+        if entry.get('accent') is not None:
+            visitor.visit_accent(entry['accent'])
+
+        extra_text = _json_extra(entry.get('extra'))
+        if extra_text is not None:
+            visitor.visit_entry_extra(extra_text)
+
+        visitor.visit_construct_entry()
+
+        if kana_list:
+            visitor.visit_kana_list(kana_list)
+        if kanji_list:
+            visitor.visit_kanji_list(kanji_list)
+
+        self._definition_accept(entry['definition'], 1, visitor)
+
+    def _definition_accept(self, definition, number, visitor):
+        visitor.visit_definition(number)
+
+        if definition.get('group') is not None:
+            visitor.visit_definition_group(definition['group'])
+
+        if 'text' in definition:
+            visitor.visit_definition_text(definition['text'])
+
+        extra_text = _json_extra(definition.get('extra'))
+        if extra_text is not None:
+            visitor.visit_definition_extra(extra_text)
+
+        visitor.visit_construct_definition()
+
+        for i, ue in enumerate(definition.get('usage_examples', ())):
+            self._usage_example_accept(ue, i+1, visitor)
+
+        visitor.visit_finish_definition_ues()
+
+        for i, subdef in enumerate(definition.get('definitions', ())):
+            self._definition_accept(subdef, i+1, visitor)
+
+        visitor.visit_finish_definition()
+
+    def _usage_example_accept(self, ue, number, visitor):
+        visitor.visit_usage_example(ue.get('type') or 'UNKNOWN')
+        visitor.visit_expression(ue.get('expression'))
+        if ue.get('reading') is not None:
+            visitor.visit_ue_reading(ue['reading'])
+        if ue.get('meaning') is not None:
+            visitor.visit_meaning(ue['meaning'])
+        if ue.get('sound') is not None:
+            visitor.visit_sound(ue['sound'])
+        if ue.get('image') is not None:
+            visitor.visit_image(ue['image'])
+        extra_text = _json_extra(ue.get('extra'))
+        if extra_text is not None:
+            visitor.visit_ue_extra(extra_text)
+        visitor.visit_ue_validated(0 if ue.get('validated') is False else 1)
+        visitor.visit_finish_usage_example(number)
+
+class JsonLinesWriterVisitor(object):
+    """Writes the visited dictionary as JsonLinesWalker records.
+
+    Records are written as JSON lines, or with MessagePack if use_msgpack
+    is True.
+    """
+    def __init__(self, f, use_msgpack=False):
+        super(JsonLinesWriterVisitor, self).__init__()
+        self.f = f
+        self.use_msgpack = use_msgpack
+        self.meta = None
+        self.entry = None
+        self.def_stack = list()
+        self.ue = None
+
+    def _write(self, record):
+        if self.use_msgpack:
+            self.f.write(msgpack.packb(record, use_bin_type=True))
+        else:
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+            self.f.write(line.encode('utf-8') + b'\n')
+
+    def visit_library(self, name):
+        self.meta = {'name': name}
+
+    def visit_library_dump_version(self, dump_version):
+        self.meta['dump_version'] = dump_version
+
+    def visit_library_convert_version(self, convert_version):
+        self.meta['convert_version'] = convert_version
+
+    def visit_library_date(self, date):
+        self.meta['date'] = date
+
+    def visit_library_extra(self, extra):
+        self.meta['extra'] = json.loads(extra)
+
+    def visit_finish_library(self):
+        self._write({'dictionary_meta': self.meta})
+
+    def visit_entry(self, number):
+        self.entry = dict()
+
+    def visit_entry_format(self, eformat):
+        self.entry['format'] = eformat
+
+    def visit_kana_raw_list(self, kana_raw_list):
+        pass
+
+    def visit_kanji_raw_list(self, kanji_raw_list):
+        pass
+
+    def visit_accent(self, accent):
+        self.entry['accent'] = accent
+
+    def visit_entry_extra(self, extra):
+        self.entry['extra'] = json.loads(extra)
+
+    def visit_construct_entry(self):
+        pass
+
+    def visit_kana_list(self, kana_list):
+        self.entry['kana'] = kana_list
+
+    def visit_kanji_list(self, kanji_list):
+        self.entry['kanji'] = kanji_list
+
+    def visit_definition(self, number):
+        definition = dict()
+        if self.def_stack:
+            self.def_stack[-1].setdefault('definitions', []).append(definition)
+        else:
+            self.entry['definition'] = definition
+        self.def_stack.append(definition)
+
+    def visit_definition_group(self, group):
+        self.def_stack[-1]['group'] = group
+
+    def visit_definition_text(self, text):
+        self.def_stack[-1]['text'] = text
+
+    def visit_definition_extra(self, extra):
+        self.def_stack[-1]['extra'] = json.loads(extra)
+
+    def visit_construct_definition(self):
+        pass
+
+    def visit_finish_definition_ues(self):
+        pass
+
+    def visit_finish_definition(self):
+        self.def_stack.pop()
+
+    def visit_usage_example(self, ue_type):
+        self.ue = {'type': ue_type}
+
+    def visit_expression(self, expression):
+        self.ue['expression'] = expression
+
+    def visit_ue_reading(self, reading):
+        self.ue['reading'] = reading
+
+    def visit_meaning(self, meaning):
+        self.ue['meaning'] = meaning
+
+    def visit_sound(self, sound):
+        self.ue['sound'] = sound
+
+    def visit_image(self, image):
+        self.ue['image'] = image
+
+    def visit_ue_extra(self, extra):
+        self.ue['extra'] = json.loads(extra)
+
+    def visit_ue_validated(self, is_validated):
+        if not is_validated:
+            self.ue['validated'] = False
+
+    def visit_finish_usage_example(self, number):
+        self.def_stack[-1].setdefault('usage_examples', []).append(self.ue)
+
+    def visit_finish_entry(self):
+        self._write({'entry': self.entry})
+
+def convert_xml_to_jsonl(xml_path, out_path):
+    """Converts an XML importable to a JsonLinesWalker importable.
+
+    The output is MessagePack if out_path ends in .msgpack or .mpk.
+    """
+    walker = DictionaryWalker(xml_path)
+    with open_importable(xml_path) as f, open(out_path, 'wb') as out:
+        writer = JsonLinesWriterVisitor(out, use_msgpack=_is_msgpack(out_path))
+        context = etree.iterparse(f, tag=(ENTRY_TAG, DICTIONARY_META_TAG))
+        for action, elem in context:
+            if elem.tag == ENTRY_TAG:
+                walker._entry_accept(elem, writer, None)
+                writer.visit_finish_entry()
+                walker._release(elem)
+            elif elem.tag == DICTIONARY_META_TAG:
+                walker._dictionary_meta_accept(elem, writer)
+                elem.clear()
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        convert_xml_to_jsonl(sys.argv[2], sys.argv[3])
+        return
+
+    from sqlalchemy import create_engine
+    from noj import init_db
+    engine = create_engine('sqlite:///../../test.sqlite', echo=False)
+    init_db(engine)
+    importable_path = sys.argv[1]
+
+    import progressbar as pb
+    widgets = ['Importing: ', pb.Percentage(), ' ', pb.Bar(),
+               ' ', pb.Timer(), ' ']
+
+    session = Session()
+    importer = JsonLinesWalker(importable_path)
+    parse_cache = ParseCache('../../parse_cache.sqlite',
+                             JapaneseParser().dictionary_identity())
+    parser = ParsePipeline(parse_cache=parse_cache)
+    visitor = DictionaryImporterVisitor(session, parser, buffered=True,
+                                        parse_cache=parse_cache)
+
+    pbar = pb.ProgressBar(widgets=widgets, maxval=len(importer)).start()
+    for i in importer.import_generator(visitor):
+        pbar.update(i)
+
+    session.commit()
+    session.close()
+    parser.close()
+    parse_cache.close()
+    pbar.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import logging
+import shutil
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# ioctl that makes a copy-on-write clone of a file on btrfs and XFS
+FICLONE = 0x40049409
+
+def _same_file(src_stat, dest_path):
+    try:
+        dest_stat = os.stat(dest_path)
+    except OSError:
+        return False
+    return dest_stat.st_size == src_stat.st_size and \
+        int(dest_stat.st_mtime) == int(src_stat.st_mtime)
+
+def _reflink(src_path, dest_path):
+    with open(src_path, 'rb') as src:
+        with open(dest_path, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+class MediaCopier(object):
+    """Copies media files on a pool of threads.
+
+    copy() queues a file and returns straight away; wait() blocks until the
+    queued files are copied. A file is skipped if the destination already
+    has the same size and modification time. On the same filesystem the
+    file is cloned (reflink) or hard linked rather than copied, otherwise
+    it is copied with its modification time. Files that cannot be copied
+    are logged and counted, but do not stop the import.
+    """
+    def __init__(self, threads=4):
+        super(MediaCopier, self).__init__()
+        self.pool = ThreadPool(threads)
+        self.lock = threading.Lock()
+        self.queued = set()  # destination paths
+        self.results = list()
+        self.start_time = None
+        self.files_copied = 0
+        self.files_linked = 0
+        self.files_skipped = 0
+        self.files_missing = 0
+        self.files_failed = 0
+        self.bytes_copied = 0
+
+    def copy(self, src_path, dest_path):
+        if dest_path in self.queued:
+            return
+        self.queued.add(dest_path)
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.results.append(self.pool.apply_async(self._copy,
+                                                  (src_path, dest_path)))
+
+    def wait(self):
+        """Waits until the queued files are copied."""
+        results, self.results = self.results, list()
+        for result in results:
+            result.get()
+
+    def close(self):
+        self.wait()
+        self.pool.close()
+        self.pool.join()
+
+    def throughput(self):
+        """Returns a summary of the copied files and the copy rate."""
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        rate = self.bytes_copied / elapsed / (1 << 20) if elapsed else 0
+        return ('{} files copied, {} linked, {} up to date, {} missing, '
+                '{} failed; {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)').format(
+                    self.files_copied, self.files_linked, self.files_skipped,
+                    self.files_missing, self.files_failed,
+                    self.bytes_copied / (1 << 20), elapsed, rate)
+
+    def _count(self, counter, size=0):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.bytes_copied += size
+
+    def _copy(self, src_path, dest_path):
+        try:
+            src_stat = os.stat(src_path)
+        except OSError:
+            self._count('files_missing')
+            return
+        if _same_file(src_stat, dest_path):
+            self._count('files_skipped')
+            return
+        try:
+            self._replace(src_path, dest_path, src_stat)
+        except (IOError, OSError) as e:
+            logging.warning('could not copy %s: %s', src_path, e)
+            self._count('files_failed')
+
+    def _replace(self, src_path, dest_path, src_stat):
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        dest_dir = os.path.dirname(dest_path) or os.curdir
+        if os.stat(dest_dir).st_dev == src_stat.st_dev:
+            if self._link(src_path, dest_path, src_stat):
+                self._count('files_linked', src_stat.st_size)
+                return
+        shutil.copy2(src_path, dest_path)
+        self._count('files_copied', src_stat.st_size)
+
+    def _link(self, src_path, dest_path, src_stat):
+        """Clones or hard links src_path, returns False if neither works."""
+        if fcntl is not None:
+            try:
+                _reflink(src_path, dest_path)
+                os.utime(dest_path, (src_stat.st_atime, src_stat.st_mtime))
+                return True
+            except (IOError, OSError):
+                if os.path.exists(dest_path):
+                    os.remove(dest_path)
+        if hasattr(os, 'link'):
+            try:
+                os.link(src_path, dest_path)
+                return True
+            except OSError:
+                pass
+        return False
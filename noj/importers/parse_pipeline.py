@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+from collections import deque
+from noj.tools.japanese_parser import JapaneseParser
+
+_worker_parser = None
+
+def _init_worker():
+    global _worker_parser
+    _worker_parser = JapaneseParser()
+
+def _parse_in_worker(text):
+    return _worker_parser.parse(text)
+
+class ParsePipeline(object):
+    """Parses texts ahead of the importer in a pool of worker processes.
+
+    Walkers call prefetch() with the texts of the entries they are about to
+    visit, in visiting order. The visitor keeps calling parse() as it would
+    on a JapaneseParser; results come back in submission order, so morpheme
+    positions and ids are the same as with a single parser. Texts that were
+    prefetched but never asked for (e.g. expressions already in the database)
+    are dropped, and texts that were never prefetched are parsed locally.
+    Texts already in parse_cache, if given, are not submitted.
+    """
+    def __init__(self, processes=None, chunksize=32, parse_cache=None):
+        super(ParsePipeline, self).__init__()
+        self.pool = multiprocessing.Pool(processes, _init_worker)
+        self.chunksize = chunksize
+        self.parse_cache = parse_cache
+        self.parser = JapaneseParser()
+        self.queue = deque()   # (text, result iterator) in submission order
+        self.queued = dict()   # text -> number of times it is in the queue
+
+    def prefetch(self, texts):
+        """Submits texts to the worker pool."""
+        if self.parse_cache is not None:
+            texts = [t for t in texts if t not in self.parse_cache]
+        else:
+            texts = list(texts)
+        if texts:
+            results = self.pool.imap(_parse_in_worker, texts, self.chunksize)
+            for text in texts:
+                self.queue.append((text, results))
+                self.queued[text] = self.queued.get(text, 0) + 1
+
+    def parse(self, expression):
+        """Returns the JapaneseParseResults for expression."""
+        if self.queued.get(expression):
+            while True:
+                text, results = self.queue.popleft()
+                self.queued[text] -= 1
+                if self.queued[text] == 0:
+                    del self.queued[text]
+                result = next(results)
+                if text == expression:
+                    return result
+        return self.parser.parse(expression)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
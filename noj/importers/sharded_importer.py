@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import re
+import sys
+import mmap
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from noj.tools.japanese_parser import JapaneseParser
+from noj.importers.compressed_io import DECOMPRESSORS
+from noj.importers.dictionary_importer import (
+    DictionaryWalker,
+    DictionaryImporterVisitor,
+)
+from noj.importers.staging import (
+    create_staging_database,
+    merge_staging_database,
+)
+
+from noj.model.models import Session
+
+# Start tag of an entry; entries are in the default namespace of the root
+ENTRY_START_RE = re.compile(br'<entry[\s/>]')
+
+class Shard(object):
+    """A run of consecutive entries of an importable, as a byte range."""
+    def __init__(self, start, end, first_entry_number, num_entries):
+        super(Shard, self).__init__()
+        self.start = start
+        self.end = end
+        self.first_entry_number = first_entry_number
+        self.num_entries = num_entries
+
+    def __repr__(self):
+        return "<Shard({!r}, {!r}, {!r})>".format(self.start, self.end,
+                                                 self.first_entry_number)
+
+def split_importable(importable_path, shards):
+    """Splits an XML dictionary into at most shards runs of entries of
+    about the same size.
+
+    Returns (prologue end, epilogue start, [Shard]). The prologue is the
+    document up to the first entry, including the dictionary meta; the
+    epilogue closes the root element. Entries are found by scanning for
+    their start tags, so entry start tags must not appear in comments or
+    CDATA sections.
+    """
+    with open(importable_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            epilogue_start = mm.rfind(b'</')
+            if epilogue_start < 0:
+                raise Exception("not an XML dictionary: " + importable_path)
+            first = ENTRY_START_RE.search(mm, 0, epilogue_start)
+            prologue_end = first.start() if first else epilogue_start
+
+            boundaries = [prologue_end]
+            body_size = epilogue_start - prologue_end
+            for k in range(1, shards):
+                target = max(prologue_end + k*body_size//shards,
+                             boundaries[-1] + 1)
+                m = ENTRY_START_RE.search(mm, target, epilogue_start)
+                if m is None:
+                    break
+                boundaries.append(m.start())
+            boundaries.append(epilogue_start)
+
+            result = list()
+            entry_number = 1
+            for start, end in zip(boundaries, boundaries[1:]):
+                num_entries = sum(1 for _ in
+                                  ENTRY_START_RE.finditer(mm, start, end))
+                result.append(Shard(start, end, entry_number, num_entries))
+                entry_number += num_entries
+        finally:
+            mm.close()
+    return prologue_end, epilogue_start, result
+
+class ByteRangeReader(object):
+    """Reads byte ranges of a file one after the other as one stream.
+
+    tell() returns the position in the file, like the file itself would.
+    """
+    def __init__(self, raw, ranges):
+        super(ByteRangeReader, self).__init__()
+        self.raw = raw
+        self.ranges = list(ranges)
+        self.remaining = 0
+        self._next_range()
+
+    def _next_range(self):
+        while self.ranges and self.remaining == 0:
+            start, end = self.ranges.pop(0)
+            self.raw.seek(start)
+            self.remaining = end - start
+
+    def read(self, size=-1):
+        chunks = list()
+        while self.remaining and size != 0:
+            n = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.raw.read(n)
+            if not data:
+                break
+            chunks.append(data)
+            self.remaining -= len(data)
+            if size > 0:
+                size -= len(data)
+            self._next_range()
+        return b''.join(chunks)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ShardWalker(DictionaryWalker):
+    """Walks one shard of a dictionary.
+
+    The prologue and epilogue are read around the shard's entries, so the
+    shard is parsed as a complete document with the dictionary meta.
+    """
+    def __init__(self, importable_path, prologue_end, epilogue_start, shard,
+                 commit_every=20000):
+        super(ShardWalker, self).__init__(importable_path, resumable=False,
+                                          commit_every=commit_every,
+                                          first_entry_number=shard.first_entry_number)
+        self.ranges = [(0, prologue_end), (shard.start, shard.end),
+                       (epilogue_start, os.path.getsize(importable_path))]
+
+    def open_importable(self):
+        return ByteRangeReader(open(self.importable_path, 'rb'), self.ranges)
+
+def _import_shard(importable_path, prologue_end, epilogue_start, shard,
+                  staging_path, commit_every):
+    """Imports a shard into a new staging database, in a worker process."""
+    engine, session = create_staging_database(staging_path)
+    walker = ShardWalker(importable_path, prologue_end, epilogue_start, shard,
+                         commit_every)
+    # Warming the empty staging database is free and lets the writer trust
+    # the cache's misses
+    visitor = DictionaryImporterVisitor(session, JapaneseParser(),
+                                        buffered=True)
+    for _ in walker.import_generator(visitor):
+        pass
+    session.commit()
+    session.close()
+    engine.dispose()
+    return staging_path
+
+def _import_shard_star(args):
+    return _import_shard(*args)
+
+class ShardedDictionaryImporter(object):
+    """Imports an XML dictionary in parallel processes.
+
+    The entries are split into shards at entry boundaries. Each shard is
+    imported by a worker process into its own staging SQLite file, and the
+    staging files are merged into the session's database in entry order as
+    they finish, with ids remapped. The result is the same as importing
+    the file with a DictionaryWalker. Compressed importables cannot be
+    split and are not supported.
+    """
+    def __init__(self, importable_path, processes=None, shards=None,
+                 commit_every=20000, staging_dir=None):
+        super(ShardedDictionaryImporter, self).__init__()
+        if os.path.splitext(importable_path)[1].lower() in DECOMPRESSORS:
+            raise Exception("compressed importables cannot be sharded: " +
+                            importable_path)
+        self.importable_path = importable_path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shards = shards or self.processes
+        self.commit_every = commit_every
+        self.staging_dir = staging_dir
+        self.split = None
+
+    def __len__(self):
+        """Returns the number of entries."""
+        if self.split is None:
+            self.split = split_importable(self.importable_path, self.shards)
+        return sum(shard.num_entries for shard in self.split[2])
+
+    def import_generator(self, session):
+        """Imports the dictionary, yields the number of entries merged after
+        each shard."""
+        if self.split is None:
+            self.split = split_importable(self.importable_path, self.shards)
+        prologue_end, epilogue_start, shards = self.split
+
+        staging_dir = tempfile.mkdtemp(prefix='noj-shards-',
+                                       dir=self.staging_dir)
+        pool = multiprocessing.Pool(min(self.processes, len(shards)))
+        try:
+            tasks = list()
+            for i, shard in enumerate(shards):
+                staging_path = os.path.join(staging_dir,
+                                            'shard{}.sqlite'.format(i))
+                tasks.append((self.importable_path, prologue_end,
+                              epilogue_start, shard, staging_path,
+                              self.commit_every))
+            pool_results = pool.imap(_import_shard_star, tasks)
+
+            library_ids = None
+            merged = 0
+            for shard, staging_path in zip(shards, pool_results):
+                library_ids = merge_staging_database(session, staging_path,
+                                                     library_ids)
+                os.remove(staging_path)
+                merged += shard.num_entries
+                logging.info('merged %s of %s entries', merged, len(self))
+                yield merged
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+def main():
+    from sqlalchemy import create_engine
+    from noj import init_db
+    engine = create_engine('sqlite:///../../test.sqlite', echo=False)
+    init_db(engine)
+    importable_path = sys.argv[1]
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    import progressbar as pb
+    widgets = ['Importing: ', pb.Percentage(), ' ', pb.Bar(),
+               ' ', pb.Timer(), ' ']
+
+    session = Session()
+    importer = ShardedDictionaryImporter(importable_path, processes)
+    pbar = pb.ProgressBar(widgets=widgets, maxval=len(importer)).start()
+    for i in importer.import_generator(session):
+        pbar.update(i)
+
+    session.commit()
+    session.close()
+    pbar.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from noj.model import models, db
+
+# A staging database is thrown away if the import fails, so it is loaded
+# without any durability
+STAGING_PRAGMAS = [('synchronous', 'OFF'),
+                   ('journal_mode', 'MEMORY'),
+                   ('temp_store', 'MEMORY'),
+                   ('cache_size', '-262144'),] # in KiB, i.e. 256 MiB
+
+# Rows matched with existing rows on their unique_fields, in merge order
+UNIQUE_CLASSES = [models.UEType, models.EntryFormat, models.Morpheme,
+                  models.Expression]
+
+# Rows appended after the existing rows by shifting their ids
+OFFSET_CLASSES = [models.Entry, models.Definition]
+
+# Association rows, inserted with both ends remapped
+ASSOCIATION_CLASSES = [models.EntryHasKana, models.EntryHasKanji,
+                       models.DefinitionConsistsOf, models.DefinitionHasUEs]
+
+def create_staging_database(staging_path):
+    """Creates the tables in a new staging database without secondary
+    indexes, returns (engine, session). Bulk loads in the session use
+    STAGING_PRAGMAS."""
+    engine = create_engine('sqlite:///' + staging_path)
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.info['bulk_load_pragmas'] = STAGING_PRAGMAS
+    db.drop_secondary_indexes(session)
+    session.commit()
+    return engine, session
+
+@contextmanager
+def staged_import(session, staging_dir=None, replace_library_ids=None):
+    """Yields a session on a temporary staging database to import into.
+
+    When the block exits without error, the staging database is merged into
+    the database of session with merge_staging_database, so the database
+    is only locked for the merge. The libraries in replace_library_ids,
+    a list which can be filled in the block, are deleted by the merge. The
+    staging file is removed afterwards.
+    """
+    fd, staging_path = tempfile.mkstemp(prefix='noj-staging-',
+                                        suffix='.sqlite', dir=staging_dir)
+    os.close(fd)
+    engine = None
+    try:
+        engine, staging_session = create_staging_database(staging_path)
+        try:
+            yield staging_session
+            staging_session.commit()
+        finally:
+            staging_session.close()
+        merge_staging_database(session, staging_path,
+                               replace_library_ids=replace_library_ids or ())
+    finally:
+        if engine is not None:
+            engine.dispose()
+        os.remove(staging_path)
+
+def _quote(name):
+    return '"{}"'.format(name)
+
+def _map_table(table_name):
+    """Returns the name of the temporary table mapping staging ids of
+    table_name to ids in the main database."""
+    return 'merge_' + table_name
+
+def _column_values(table, remaps, with_id=False):
+    """Returns [(column name, SQL value)] selecting the columns of table from
+    the staging copy aliased s, with foreign keys remapped.
+
+    remaps maps a table name to the offset added to its ids, or to None if
+    its ids are looked up in the table's map table.
+    """
+    values = list()
+    for c in table.columns:
+        value = 's.' + _quote(c.name)
+        if c.primary_key and c.name == 'id':
+            if not with_id:
+                continue
+            target = table.name
+        else:
+            fks = list(c.foreign_keys)
+            target = fks[0].column.table.name if fks else None
+        if target in remaps:
+            if remaps[target] is None:
+                value = '(SELECT new_id FROM {} WHERE old_id = {})'.format(
+                    _map_table(target), value)
+            else:
+                value = '{} + {}'.format(value, int(remaps[target]))
+        values.append((c.name, value))
+    return values
+
+def _insert_select(table, values, whereclause=None, order_by=None,
+                   ignore=False):
+    sql = 'INSERT {}INTO main.{} ({}) SELECT {} FROM staging.{} s'.format(
+        'OR IGNORE ' if ignore else '', _quote(table.name),
+        ', '.join(_quote(name) for name, _ in values),
+        ', '.join(value for _, value in values), _quote(table.name))
+    if whereclause is not None:
+        sql += ' WHERE ' + whereclause
+    if order_by is not None:
+        sql += ' ORDER BY ' + order_by
+    return sql
+
+def _create_map_table(cursor, table_name):
+    cursor.execute('DROP TABLE IF EXISTS ' + _map_table(table_name))
+    cursor.execute('CREATE TEMP TABLE {} (old_id INTEGER PRIMARY KEY, '
+                   'new_id INTEGER NOT NULL, is_new INTEGER NOT NULL)'.format(
+                       _map_table(table_name)))
+
+def _merge_libraries(cursor, remaps, library_ids):
+    table = models.Library.__table__
+    _create_map_table(cursor, table.name)
+    if library_ids is None:
+        library_ids = dict()
+        values = _column_values(table, remaps)
+        rows = cursor.execute('SELECT s.id FROM staging.{} s ORDER BY s.id'.\
+                              format(table.name)).fetchall()
+        for (old_id,) in rows:
+            cursor.execute(_insert_select(table, values, 's.id = ?'), (old_id,))
+            library_ids[old_id] = cursor.lastrowid
+    cursor.executemany('INSERT INTO {} VALUES (?, ?, 0)'.format(
+        _map_table(table.name)), library_ids.items())
+    remaps[table.name] = None
+    return library_ids
+
+def _merge_unique(cursor, orm_class, remaps):
+    """Maps staging rows to the main rows with the same unique_fields and
+    appends the others in staging order, so ids are assigned in the order
+    a direct import would have assigned them."""
+    table = orm_class.__table__
+    map_table = _map_table(table.name)
+    _create_map_table(cursor, table.name)
+    values = _column_values(table, remaps)
+    by_name = dict(values)
+    join = ' AND '.join('m.{} = {}'.format(_quote(f), by_name[f])
+                        for f in orm_class.unique_fields)
+    mapper = ('INSERT INTO {map} SELECT s.id, m.id, {{}} '
+              'FROM staging.{t} s JOIN main.{t} m ON {join} '
+              'WHERE s.id NOT IN (SELECT old_id FROM {map})').format(
+                  map=map_table, t=_quote(table.name), join=join)
+    cursor.execute(mapper.format(0))
+    cursor.execute(_insert_select(table, values,
+        's.id NOT IN (SELECT old_id FROM {})'.format(map_table), 's.id'))
+    cursor.execute(mapper.format(1))
+    remaps[table.name] = None
+
+def _merge_offset(cursor, orm_class, remaps):
+    table = orm_class.__table__
+    cursor.execute('SELECT coalesce(max(id), 0) FROM main.' + _quote(table.name))
+    remaps[table.name] = cursor.fetchone()[0]
+    cursor.execute(_insert_select(table, _column_values(table, remaps, True)))
+
+def _merge_associations(cursor, orm_class, remaps, whereclause=None):
+    table = orm_class.__table__
+    cursor.execute(_insert_select(table, _column_values(table, remaps),
+                                  whereclause, ignore=True))
+
+def _execute(cursor, statement, dialect):
+    """Executes an SQLAlchemy statement on a DB-API cursor."""
+    compiled = statement.compile(dialect=dialect)
+    params = compiled.construct_params()
+    cursor.execute(unicode(compiled),
+                   [params[name] for name in compiled.positiontup])
+
+def _score_usage_examples(cursor, dialect):
+    # Staging databases have no known examples, so their scores are off
+    _execute(cursor, db.n_score_update(text(
+        'id IN (SELECT new_id FROM {} WHERE is_new)'.format(
+            _map_table(models.UsageExample.__tablename__)))), dialect)
+
+def _bump_generation(cursor):
+    # Like db.bump_generation, on the raw connection
+    cursor.execute('UPDATE main.databasegeneration '
+                   'SET generation = generation + 1')
+    if cursor.rowcount == 0:
+        cursor.execute('INSERT INTO main.databasegeneration (id, generation) '
+                       'VALUES (1, 1)')
+
+def merge_staging_database(session, staging_path, library_ids=None,
+                           replace_library_ids=()):
+    """Merges the libraries of a staging database into the session's
+    database, in one transaction.
+
+    Morphemes, expressions, usage example types, entry formats and usage
+    examples that already exist are reused, the other rows get new ids.
+    New usage examples are scored with the known examples of the database.
+    The morphemes of an expression are only added with the expression.
+    Schema validations recorded in the staging database are kept. If
+    library_ids maps the staging library ids to existing libraries, rows
+    are added to those libraries instead of new ones. The libraries in
+    replace_library_ids are deleted in the same transaction, so they are
+    only gone once the new ones are in. Returns the mapping of staging
+    library ids to library ids.
+    """
+    session.commit()
+    # The session's own connection, so db functions can run in the merge
+    raw = session.connection().connection
+    connection = raw.connection
+    isolation_level = connection.isolation_level
+    # ATTACH cannot run inside a transaction, so transactions are explicit
+    connection.isolation_level = None
+    cursor = raw.cursor()
+    try:
+        cursor.execute('ATTACH DATABASE ? AS staging', (staging_path,))
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for library_id in replace_library_ids:
+                    db.delete_library(session, library_id)
+                remaps = dict()
+                library_ids = _merge_libraries(cursor, remaps, library_ids)
+                for orm_class in UNIQUE_CLASSES:
+                    _merge_unique(cursor, orm_class, remaps)
+                _merge_associations(cursor, models.ExpressionConsistsOf, remaps,
+                    's.expression_id IN (SELECT old_id FROM {} '
+                    'WHERE is_new)'.format(_map_table('expressions')))
+                for orm_class in OFFSET_CLASSES:
+                    _merge_offset(cursor, orm_class, remaps)
+                _merge_unique(cursor, models.UsageExample, remaps)
+                _score_usage_examples(cursor, session.get_bind().dialect)
+                for orm_class in ASSOCIATION_CLASSES:
+                    _merge_associations(cursor, orm_class, remaps)
+                _merge_associations(cursor, models.ValidatedImportable, remaps)
+                for table_name, offset in remaps.items():
+                    if offset is None:
+                        cursor.execute('DROP TABLE ' + _map_table(table_name))
+                _bump_generation(cursor)
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+        finally:
+            cursor.execute('DETACH DATABASE staging')
+    finally:
+        cursor.close()
+        connection.isolation_level = isolation_level
+        # Ends the session's transaction, which has nothing left to commit
+        session.rollback()
+    return library_ids
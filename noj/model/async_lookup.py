@@ -7,6 +7,7 @@ from functools import partial
 from puremvc.patterns.proxy import Proxy
 from multiprocessing.pool import ThreadPool
 from noj.model.lookup_ues import LookupUEs
+from noj.model.lookup_cache import LookupCache
 from noj.model.models import Session
 import noj
 
@@ -18,19 +19,24 @@ class AsyncLookup(Proxy, QObject):
         super(AsyncLookup, self).__init__()
         QObject.__init__(self, parent=None)
         # self.pool = ThreadPool()
+        # Shared by the workers, so going back to a word is not searched again
+        self.cache = LookupCache()
 
     def lookup_entries(self, search_word, limit=None, offset=None, callback=None):
         print "looking up entries..."
-        self.entry_worker = AsyncEntryLookupWorker(search_word, limit, offset, callback)
+        self.entry_worker = AsyncEntryLookupWorker(search_word, limit, offset, callback,
+                                                    self.cache)
         self.connect(self.entry_worker, SIGNAL("searchFinished"), self.done_entries)
         self.entry_worker.start()
 
-    def lookup_ues_by_entry(self, search_word, limit=None, offset=None, callback=None):
+    def lookup_ues_by_entry(self, search_word, limit=None, offset=None, callback=None,
+                            exact_count=True, cursor=None):
         print "looking up ues by entries..."
         # result = self.pool.apply_async(_lookup_ues_by_entry, (search_word, limit, offset, callback),
         #     callback=partial(self.sendNotification, noj.AppFacade.LOOKUP_DONE))
         # result = self.pool.apply_async(_lookup_ues_by_entry, (search_word, limit, offset, callback))
-        self.worker = AsyncLookupWorker(search_word, limit, offset, callback)
+        self.worker = AsyncLookupWorker(search_word, limit, offset, callback,
+                                        self.cache, exact_count, cursor)
         self.connect(self.worker, SIGNAL("searchFinished"), self.done_ues_by_entry)
         self.worker.start()
         # result.get()
@@ -57,24 +63,33 @@ class AsyncLookup(Proxy, QObject):
         print "looking up ues by definitions..."
         pass
 
-    def lookup_ues_by_expression(self, search_word, limit=None, offset=None, callback=None):
+    def lookup_ues_by_expression(self, search_word, limit=None, offset=None, callback=None,
+                                 exact_count=True, cursor=None):
         print "looking up ues by expressions..."
-        self.expression_worker = AsyncExpressionLookupWorker(search_word, limit, offset, callback)
+        self.expression_worker = AsyncExpressionLookupWorker(search_word, limit, offset,
+                                                             callback, self.cache,
+                                                             exact_count, cursor)
         self.connect(self.expression_worker, SIGNAL("searchFinished"), self.done_ues_by_expression)
         self.expression_worker.start()
 
 class AsyncLookupWorker(QThread):
     """docstring for AsyncLookupWorker"""
-    def __init__(self, search_word, limit, offset, callback, parent=None):
+    def __init__(self, search_word, limit, offset, callback, cache,
+                 exact_count=True, cursor=None, parent=None):
         super(AsyncLookupWorker, self).__init__(parent)
         self.search_word = search_word
         self.limit = limit
         self.offset = offset
         self.callback = callback
+        self.cache = cache
+        self.exact_count = exact_count
+        self.cursor = cursor
 
     def run(self):
         session = Session()
-        ues = LookupUEs.lookup_ues_by_entry(session, self.search_word, self.limit, self.offset)
+        ues = self.cache.lookup(session, 'lookup_ues_by_entry', self.search_word,
+                                self.limit, self.offset,
+                                exact_count=self.exact_count, cursor=self.cursor)
         # print unicode(ues)
         unicode(ues)
         if self.callback is not None:
@@ -85,16 +100,19 @@ class AsyncLookupWorker(QThread):
         # return ues
 
 class AsyncEntryLookupWorker(QThread):
-    def __init__(self, search_word, limit, offset, callback, parent=None):
+    def __init__(self, search_word, limit, offset, callback, cache,
+                 parent=None):
         super(AsyncEntryLookupWorker, self).__init__(parent)
         self.search_word = search_word
         self.limit = limit
         self.offset = offset
         self.callback = callback
+        self.cache = cache
 
     def run(self):
         session = Session()
-        entries = LookupUEs.lookup_entries(session, self.search_word, self.limit, self.offset)
+        entries = self.cache.lookup(session, 'lookup_entries', self.search_word,
+                                    self.limit, self.offset)
         # print unicode(entries)
         unicode(entries)
         if self.callback is not None:
@@ -105,16 +123,23 @@ class AsyncEntryLookupWorker(QThread):
         # return entries
 
 class AsyncExpressionLookupWorker(QThread):
-    def __init__(self, search_word, limit, offset, callback, parent=None):
+    def __init__(self, search_word, limit, offset, callback, cache,
+                 exact_count=True, cursor=None, parent=None):
         super(AsyncExpressionLookupWorker, self).__init__(parent)
         self.search_word = search_word
         self.limit = limit
         self.offset = offset
         self.callback = callback
+        self.cache = cache
+        self.exact_count = exact_count
+        self.cursor = cursor
 
     def run(self):
         session = Session()
-        entries = LookupUEs.lookup_ues_by_expression(session, self.search_word, self.limit, self.offset)
+        entries = self.cache.lookup(session, 'lookup_ues_by_expression',
+                                    self.search_word, self.limit, self.offset,
+                                    exact_count=self.exact_count,
+                                    cursor=self.cursor)
         # print unicode(entries)
         unicode(entries)
         if self.callback is not None:
@@ -1,7 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from sqlalchemy.sql import and_, select, func
-import noj.model.models
+from contextlib import contextmanager
+from sqlalchemy.sql import and_, select, func, bindparam
+from noj.model import models, db_constants
+
+# Fewer fsyncs while importing. The journal stays on disk, so a crash can
+# lose the last commit but never corrupts the database.
+BULK_LOAD_PRAGMAS = [('synchronous', 'NORMAL'),
+                     ('journal_mode', 'WAL'),
+                     ('temp_store', 'MEMORY'),
+                     ('cache_size', '-262144'),] # in KiB, i.e. 256 MiB
+
+# SQLite's default limit on bound parameters in one statement
+MAX_SQL_VARIABLES = 999
+
+# A morpheme in this many known expressions no longer adds to n_score
+KNOWN_EXPR_COUNT = 3
 
 def insert_get(session, orm_class, **kwargs):
     new = True
@@ -95,6 +109,240 @@ def insert_expression(session, parser, ue_expression, morpheme_cache):
                              expression_components)
     return expression_id
 
+def get_generation(session):
+    """Returns the database generation, see bump_generation."""
+    generations = models.DatabaseGeneration.__table__
+    return session.execute(select([generations.c.generation])).scalar() or 0
+
+def bump_generation(session):
+    """Increments the database generation, in the session's transaction.
+
+    Call it whenever libraries change, so cached lookup results are
+    dropped once the change is committed.
+    """
+    generations = models.DatabaseGeneration.__table__
+    r = session.execute(generations.update().\
+                        values(generation=generations.c.generation + 1))
+    if r.rowcount == 0:
+        session.execute(generations.insert().values(id=1, generation=1))
+
+def add_missing_columns(session):
+    """Adds model columns missing from existing tables.
+
+    create_all only creates missing tables. The added columns are NULL in
+    existing rows, or their server default, which a column that is not
+    nullable must have.
+    """
+    dialect = session.get_bind().dialect
+    for table in models.Base.metadata.sorted_tables:
+        rows = session.execute('PRAGMA table_info("{}")'.format(table.name))
+        existing = set(row[1] for row in rows)
+        if not existing:
+            continue
+        for c in table.columns:
+            if c.name not in existing:
+                ddl = 'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                    table.name, c.name, c.type.compile(dialect))
+                if c.server_default is not None:
+                    if not c.nullable:
+                        ddl += ' NOT NULL'
+                    ddl += ' DEFAULT {}'.format(c.server_default.arg)
+                session.execute(ddl)
+    session.commit()
+
+def get_pragmas(session, names):
+    return [(name, session.execute('PRAGMA {}'.format(name)).scalar())
+            for name in names]
+
+def set_pragmas(session, pragmas):
+    for name, value in pragmas:
+        session.execute('PRAGMA {}={}'.format(name, value))
+
+def drop_secondary_indexes(session):
+    """Drops the explicitly created indexes.
+
+    Indexes backing primary keys and unique constraints are kept. Returns
+    the statements needed to create the dropped indexes again.
+    """
+    rows = session.execute("SELECT name, sql FROM sqlite_master "
+                           "WHERE type='index' AND sql IS NOT NULL").fetchall()
+    for row in rows:
+        session.execute('DROP INDEX "{}"'.format(row.name))
+    return [row.sql for row in rows]
+
+class BulkLoader(object):
+    """Commits a bulk load in large transactions.
+
+    Call step() after each imported item. Callables in before_commit are
+    run before every commit.
+    """
+    def __init__(self, session, commit_every, pragmas=BULK_LOAD_PRAGMAS):
+        super(BulkLoader, self).__init__()
+        self.session = session
+        self.commit_every = commit_every
+        self.pragmas = pragmas
+        self.steps = 0
+        self.before_commit = list()
+
+    def step(self):
+        self.steps += 1
+        if self.commit_every and self.steps % self.commit_every == 0:
+            self.commit()
+
+    def commit(self):
+        for f in self.before_commit:
+            f()
+        score_new_usage_examples(self.session)
+        bump_generation(self.session)
+        self.session.commit()
+        # The session may get a new connection, which has default pragmas
+        set_pragmas(self.session, self.pragmas)
+
+@contextmanager
+def bulk_load(session, commit_every=20000, drop_indexes=True):
+    """Sets up the database for a fast bulk import.
+
+    Commits pending changes, applies the pragmas in the session's
+    info['bulk_load_pragmas'], or BULK_LOAD_PRAGMAS, and, if drop_indexes
+    is True, drops the secondary indexes. Yields a BulkLoader which commits
+    every commit_every steps. On exit the remaining work is committed (or
+    rolled back on error), the indexes are rebuilt and the pragmas restored.
+    """
+    session.commit()
+    pragmas = session.info.get('bulk_load_pragmas', BULK_LOAD_PRAGMAS)
+    old_pragmas = get_pragmas(session, [name for name, _ in pragmas])
+    set_pragmas(session, pragmas)
+    index_sqls = list()
+    if drop_indexes:
+        index_sqls = drop_secondary_indexes(session)
+    loader = BulkLoader(session, commit_every, pragmas)
+    try:
+        yield loader
+        loader.commit()
+    finally:
+        session.rollback()
+        for sql in index_sqls:
+            session.execute(sql)
+        session.commit()
+        set_pragmas(session, old_pragmas)
+
+def recount_morpheme_expr_counts(session, ue_list_id, expression_ids=None):
+    """Sets Morpheme.expr_count from the expressions in a usage example list.
+
+    expr_count is the number of times a morpheme occurs in the distinct
+    expressions of the list. The counts are computed with one aggregate
+    query over the list. If expression_ids is given, only the morphemes of
+    those expressions are recounted.
+    """
+    usage_examples = models.UsageExample.__table__
+    expression_consists_of = models.ExpressionConsistsOf.__table__
+    morphemes = models.Morpheme.__table__
+    ue_part_of_list = models.ue_part_of_list
+
+    list_expressions = select([usage_examples.c.expression_id],
+        from_obj=[usage_examples.join(ue_part_of_list)],
+        whereclause=ue_part_of_list.c.ue_list_id==ue_list_id)
+    in_list = expression_consists_of.c.expression_id.in_(list_expressions)
+
+    # Morphemes that no longer occur in the list end up with a count of 0
+    old_counts = dict()
+    if expression_ids is None:
+        whereclauses = [in_list]
+        old_counts.update(session.execute(
+            select([morphemes.c.id, morphemes.c.expr_count],
+                   morphemes.c.expr_count!=0)).fetchall())
+        session.execute(morphemes.update().where(morphemes.c.expr_count!=0).\
+                        values(expr_count=0))
+    else:
+        whereclauses = list()
+        touched_chunks = list()
+        expression_ids = list(expression_ids)
+        for i in range(0, len(expression_ids), MAX_SQL_VARIABLES):
+            touched = select([expression_consists_of.c.morpheme_id],
+                expression_consists_of.c.expression_id.in_(
+                    expression_ids[i:i+MAX_SQL_VARIABLES]))
+            touched_chunks.append(touched)
+            whereclauses.append(and_(in_list,
+                expression_consists_of.c.morpheme_id.in_(touched)))
+        # Chunks share morphemes, so every count is read before any is reset
+        for touched in touched_chunks:
+            old_counts.update(session.execute(
+                select([morphemes.c.id, morphemes.c.expr_count],
+                       morphemes.c.id.in_(touched))).fetchall())
+        for touched in touched_chunks:
+            session.execute(morphemes.update().\
+                            where(morphemes.c.id.in_(touched)).\
+                            values(expr_count=0))
+
+    new_counts = dict()
+    for whereclause in whereclauses:
+        s = select([expression_consists_of.c.morpheme_id, func.count()],
+                   whereclause).group_by(expression_consists_of.c.morpheme_id)
+        new_counts.update(session.execute(s).fetchall())
+
+    if new_counts:
+        morpheme_count_updater = morphemes.update().\
+            where(morphemes.c.id==bindparam('m_id')).\
+            values(expr_count=bindparam('new_count'))
+        session.execute(morpheme_count_updater,
+                        [{'m_id':morpheme_id, 'new_count':count}
+                         for morpheme_id, count in new_counts.items()])
+
+    # Only counts below KNOWN_EXPR_COUNT make a difference to n_score
+    changed = [m_id for m_id in set(old_counts) | set(new_counts)
+               if min(old_counts.get(m_id) or 0, KNOWN_EXPR_COUNT) !=
+                  min(new_counts.get(m_id, 0), KNOWN_EXPR_COUNT)]
+    rescore_morphemes(session, changed)
+
+def n_score_update(whereclause=None):
+    """Returns an UPDATE setting UsageExample.n_score of the usage examples
+    matching whereclause, or of all of them.
+
+    The score is len(expression)/100, plus (3 - expr_count)/3 for each
+    morpheme of the expression with an expr_count below KNOWN_EXPR_COUNT,
+    like UsageExample.get_expression_score.
+    """
+    usage_examples = models.UsageExample.__table__
+    # Aliased, so the statement can be filtered on the same tables
+    expressions = models.Expression.__table__.alias()
+    expression_consists_of = models.ExpressionConsistsOf.__table__.alias()
+    morphemes = models.Morpheme.__table__.alias()
+
+    expr_count = func.coalesce(morphemes.c.expr_count, 0)
+    length = select([func.length(expressions.c.expression) / 100.0],
+                    expressions.c.id==usage_examples.c.expression_id)
+    unknown = select(
+        [func.coalesce(func.sum((KNOWN_EXPR_COUNT - expr_count) /
+                                float(KNOWN_EXPR_COUNT)), 0)],
+        and_(expression_consists_of.c.expression_id==usage_examples.c.expression_id,
+             expr_count < KNOWN_EXPR_COUNT),
+        from_obj=[expression_consists_of.join(morphemes)])
+    update = usage_examples.update().values(
+        n_score=length.correlate(usage_examples).as_scalar() +
+                unknown.correlate(usage_examples).as_scalar(),
+        is_scored=1)
+    if whereclause is not None:
+        update = update.where(whereclause)
+    return update
+
+def score_new_usage_examples(session):
+    """Sets n_score of the usage examples that are not scored yet."""
+    usage_examples = models.UsageExample.__table__
+    session.execute(n_score_update(usage_examples.c.is_scored==0))
+
+def rescore_morphemes(session, morpheme_ids):
+    """Sets n_score of the usage examples with any of the morphemes, after
+    their expr_counts changed."""
+    usage_examples = models.UsageExample.__table__
+    expression_consists_of = models.ExpressionConsistsOf.__table__
+    morpheme_ids = list(morpheme_ids)
+    for i in range(0, len(morpheme_ids), MAX_SQL_VARIABLES):
+        expression_ids = select([expression_consists_of.c.expression_id],
+            expression_consists_of.c.morpheme_id.in_(
+                morpheme_ids[i:i+MAX_SQL_VARIABLES]))
+        session.execute(n_score_update(
+            usage_examples.c.expression_id.in_(expression_ids)))
+
 def stage_morpheme_counts(session, ue_list_id, expression_id, morpheme_count):
     # expressions     = models.Expression.__table__
     usage_examples  = models.UsageExample.__table__
@@ -118,4 +366,85 @@ def stage_morpheme_counts(session, ue_list_id, expression_id, morpheme_count):
             else:
                 morpheme_count[m.id] = (m.count or 0) + 1
 
-    
+def delete_library(session, library_id):
+    """Deletes a library with its entries, definitions and usage examples.
+
+    Rows are deleted with one statement per table, children first, so no
+    ORM objects are loaded. Expressions and morphemes are kept; see
+    collect_garbage. The counts of morphemes in the Known Examples list
+    are recounted if the library had usage examples in it. The database
+    generation is bumped.
+    """
+    libraries = models.Library.__table__
+    entries = models.Entry.__table__
+    definitions = models.Definition.__table__
+    usage_examples = models.UsageExample.__table__
+    ue_part_of_list = models.ue_part_of_list
+
+    entry_ids = select([entries.c.id], entries.c.library_id==library_id)
+    definition_ids = select([definitions.c.id],
+                            definitions.c.entry_id.in_(entry_ids))
+    ue_ids = select([usage_examples.c.id],
+                    usage_examples.c.library_id==library_id)
+
+    s = select([usage_examples.c.expression_id],
+        from_obj=[usage_examples.join(ue_part_of_list)],
+        whereclause=and_(usage_examples.c.library_id==library_id,
+            ue_part_of_list.c.ue_list_id==db_constants.KNOWN_EXAMPLES_ID))
+    known_expression_ids = set(row[0] for row in session.execute(s))
+
+    definition_has_ues = models.DefinitionHasUEs.__table__
+    session.execute(definition_has_ues.delete().where(
+        definition_has_ues.c.definition_id.in_(definition_ids)))
+    session.execute(definition_has_ues.delete().where(
+        definition_has_ues.c.usage_example_id.in_(ue_ids)))
+    definition_consists_of = models.DefinitionConsistsOf.__table__
+    session.execute(definition_consists_of.delete().where(
+        definition_consists_of.c.definition_id.in_(definition_ids)))
+    session.execute(ue_part_of_list.delete().where(
+        ue_part_of_list.c.usage_example_id.in_(ue_ids)))
+    session.execute(usage_examples.delete().where(
+        usage_examples.c.library_id==library_id))
+    session.execute(definitions.delete().where(
+        definitions.c.entry_id.in_(entry_ids)))
+    for table in (models.EntryHasKana.__table__, models.EntryHasKanji.__table__):
+        session.execute(table.delete().where(table.c.entry_id.in_(entry_ids)))
+    session.execute(entries.delete().where(entries.c.library_id==library_id))
+    checkpoints = models.ImportCheckpoint.__table__
+    session.execute(checkpoints.delete().where(
+        checkpoints.c.library_id==library_id))
+    session.execute(libraries.delete().where(libraries.c.id==library_id))
+
+    if known_expression_ids:
+        recount_morpheme_expr_counts(session, db_constants.KNOWN_EXAMPLES_ID,
+                                     known_expression_ids)
+    bump_generation(session)
+
+def collect_garbage(session):
+    """Deletes expressions without usage examples and automatically added
+    morphemes that nothing refers to any more.
+
+    Morphemes with a status set by the user are kept. Returns the number of
+    deleted (expressions, morphemes).
+    """
+    expressions = models.Expression.__table__
+    morphemes = models.Morpheme.__table__
+    usage_examples = models.UsageExample.__table__
+    expression_consists_of = models.ExpressionConsistsOf.__table__
+
+    used_expressions = select([usage_examples.c.expression_id])
+    session.execute(expression_consists_of.delete().where(
+        ~expression_consists_of.c.expression_id.in_(used_expressions)))
+    r = session.execute(expressions.delete().where(
+        ~expressions.c.id.in_(used_expressions)))
+    num_expressions = r.rowcount
+
+    whereclauses = [morphemes.c.status_id==
+                    db_constants.MORPHEME_STATUSES_TO_ID['AUTO']]
+    for column in (expression_consists_of.c.morpheme_id,
+                   models.DefinitionConsistsOf.__table__.c.morpheme_id,
+                   models.EntryHasKana.__table__.c.kana_id,
+                   models.EntryHasKanji.__table__.c.kanji_id):
+        whereclauses.append(~morphemes.c.id.in_(select([column])))
+    r = session.execute(morphemes.delete().where(and_(*whereclauses)))
+    return (num_expressions, r.rowcount)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+import logging
+from sqlalchemy import event
+from noj.model import models
+from noj.model.lookup_ues import LookupUEs
+
+# (name, table, columns) of the indexes the LookupUEs queries rely on.
+# morphemes(morpheme) is served by the index of the unique constraint on
+# (morpheme, type_id), and the other joins by primary keys.
+LOOKUP_INDEXES = [
+    # Entries by kana or kanji
+    ('ix_entryhaskana_kana_id', 'entryhaskana', ['kana_id', 'entry_id']),
+    ('ix_entryhaskanji_kanji_id', 'entryhaskanji', ['kanji_id', 'entry_id']),
+    # Definitions of entries, usage examples of definitions
+    ('ix_definitions_entry_id', 'definitions', ['entry_id']),
+    ('ix_definitionhasues_definition_id', 'definitionhasues',
+     ['definition_id']),
+    # Usage examples by the morphemes of their expression or definition
+    ('ix_expressionconsistsof_morpheme_id', 'expressionconsistsof',
+     ['morpheme_id', 'expression_id']),
+    ('ix_usageexamples_expression_id', 'usageexamples', ['expression_id']),
+    ('ix_definitionconsistsof_morpheme_id', 'definitionconsistsof',
+     ['morpheme_id', 'definition_id']),
+    # Usage examples not scored yet
+    ('ix_usageexamples_is_scored', 'usageexamples', ['is_scored']),
+]
+
+# Indexes of earlier versions that no lookup uses. The usage example
+# lookups sort the matches of the search word (see SORTING_LOOKUPS), so
+# they never read usageexamples in n_score order.
+DROPPED_INDEXES = ['ix_usageexamples_n_score']
+
+# Lookups checked by check_query_plans, with a kana and a kanji word so
+# both kinds of entry lookup are run. lookup_ues_by_definition is left out
+# until its joins work.
+CHECKED_LOOKUPS = [(method, search_word)
+                   for method in ('lookup_entries', 'lookup_ues_by_entry',
+                                  'lookup_ues_by_expression')
+                   for search_word in (u'せんせい', u'先生')]
+
+# Lookups that sort the usage examples matching the search word. The
+# matches are found through the indexes of the search word, so they are
+# sorted in a temporary B-tree; the other lookups must not sort.
+SORTING_LOOKUPS = ('lookup_ues_by_entry', 'lookup_ues_by_expression')
+
+# A step of a query plan that reads a whole table (or its alias)
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+# A step of a query plan that sorts the rows instead of reading an index
+SORT_STEP = 'USE TEMP B-TREE FOR ORDER BY'
+
+class QueryPlanError(Exception):
+    """A lookup query scans a whole table, or sorts when it should not."""
+    pass
+
+def create_indexes(session):
+    """Creates the missing indexes in LOOKUP_INDEXES and drops the ones in
+    DROPPED_INDEXES."""
+    for name in DROPPED_INDEXES:
+        session.execute('DROP INDEX IF EXISTS "{}"'.format(name))
+    for name, table, columns in LOOKUP_INDEXES:
+        session.execute('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+            name, table, ', '.join('"{}"'.format(c) for c in columns)))
+    session.commit()
+
+def _scanned_table(detail):
+    """Returns the table a query plan step scans in full, or None."""
+    m = SCAN_RE.match(detail)
+    if m is None:
+        return None
+    # Eager loads alias tables as <table>_<n>; subqueries are anon_<n>
+    name = re.sub(r'_\d+$', '', m.group(1))
+    if name in models.Base.metadata.tables:
+        return name
+    return None
+
+def query_plan(session, statement, parameters=()):
+    """Returns the details of the steps of a statement's query plan."""
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+def check_query_plans(session, lookups=CHECKED_LOOKUPS,
+                      sorting_lookups=SORTING_LOOKUPS):
+    """Runs the lookups and checks the query plan of every statement.
+
+    Raises QueryPlanError if a statement scans a whole table, or sorts in
+    a temporary B-tree and its lookup is not in sorting_lookups.
+    """
+    statements = list()
+    may_sort = [False]
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters, may_sort[0]))
+
+    # The lookups run on the session's connection, which does not see
+    # listeners added to the engine after it was opened
+    connection = session.connection()
+    event.listen(connection, 'before_cursor_execute', record)
+    try:
+        for method, search_word in lookups:
+            may_sort[0] = method in sorting_lookups
+            getattr(LookupUEs, method)(session, search_word, 50)
+    finally:
+        event.remove(connection, 'before_cursor_execute', record)
+
+    for statement, parameters, sorts in statements:
+        plan = query_plan(session, statement, parameters)
+        scanned = [t for t in (_scanned_table(d) for d in plan) if t]
+        if scanned:
+            raise QueryPlanError("full scan of {} in:\n{}\nplan:\n{}".format(
+                ', '.join(scanned), statement, '\n'.join(plan)))
+        if not sorts and SORT_STEP in plan:
+            raise QueryPlanError("sort in:\n{}\nplan:\n{}".format(
+                statement, '\n'.join(plan)))
+    logging.info('checked the query plans of %s statements', len(statements))
+    return len(statements)
+
+def main():
+    from sqlalchemy import create_engine
+    from noj import init_db
+    from noj.model.profiles import ProfileManager
+    from noj.model.models import Session
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    pm = ProfileManager()
+    engine = create_engine(pm.database_connect_string(), echo=False)
+    init_db(engine)
+    session = Session()
+    print 'checked {} statements'.format(check_query_plans(session))
+    session.close()
+
+if __name__ == '__main__':
+    main()
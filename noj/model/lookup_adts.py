@@ -187,10 +187,18 @@ class EntryList(object):
         
 
 class UEResultList(object):
-    def __init__(self, count=None):
+    """A page of usage example results.
+
+    count is the number of results of the whole lookup; if count_is_exact
+    is False it is a lower bound. next_cursor is passed to the lookup to
+    get the next page, it is None on the last page.
+    """
+    def __init__(self, count=None, count_is_exact=True, next_cursor=None):
         super(UEResultList, self).__init__()
         self.result_list = list()
         self.count = count
+        self.count_is_exact = count_is_exact
+        self.next_cursor = next_cursor
 
     def append(self, ue_result):
         self.result_list.append(ue_result)
@@ -198,6 +206,12 @@ class UEResultList(object):
     def get_count(self):
         return self.count
 
+    def count_string(self):
+        """Returns e.g. u'50 of 120', or u'50 of 1000+' if the count is a
+        lower bound."""
+        count = self.count if self.count_is_exact else u'{}+'.format(self.count)
+        return u'{} of {}'.format(len(self), count)
+
     def __iter__(self):
         return self.result_list.__iter__()
 
@@ -275,11 +289,18 @@ class UEResult(object):
         definitions = self._get_definition_objs()
         return [d.id for d in definitions]
 
-    def get_image(self):
-        return self.usage_example.image
+    def get_image(self, media_store=None):
+        """Returns the image path, absolute if media_store is given."""
+        return self._media_path(self.usage_example.image, media_store)
+
+    def get_sound(self, media_store=None):
+        """Returns the sound path, absolute if media_store is given."""
+        return self._media_path(self.usage_example.sound, media_store)
 
-    def get_sound(self):
-        return self.usage_example.sound
+    def _media_path(self, path, media_store):
+        if media_store is None:
+            return path
+        return media_store.resolve(path)
 
     def _get_definition_objs(self):
         definitions = set()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from noj.model import db
+from noj.model.lookup_ues import LookupUEs
+
+class LookupCache(object):
+    """Bounded LRU cache in front of the LookupUEs lookups.
+
+    Results are keyed by (method, search_word, limit, offset) and the
+    options passed to the method, e.g. exact_count or cursor. The cache is
+    emptied when the database generation changes, which importers bump
+    whenever they commit. It may be shared by lookup threads.
+    """
+    def __init__(self, max_results=64):
+        super(LookupCache, self).__init__()
+        self.max_results = max_results
+        self.lock = threading.Lock()
+        self.results = OrderedDict()  # key -> result, least recent first
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def lookup(self, session, method, search_word, limit=None, offset=None,
+               **options):
+        """Returns LookupUEs.<method>(session, search_word, limit, offset,
+        **options), from the cache if it was looked up since the last
+        import."""
+        # Read before looking up, so a result is never older than the
+        # generation it is stored under
+        generation = db.get_generation(session)
+        key = (method, search_word, limit, offset,
+               tuple(sorted(options.items())))
+        with self.lock:
+            if generation != self.generation:
+                self.results.clear()
+                self.generation = generation
+            result = self.results.pop(key, None)
+            if result is not None:
+                self.results[key] = result
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = getattr(LookupUEs, method)(session, search_word, limit, offset,
+                                            **options)
+
+        with self.lock:
+            if generation == self.generation:
+                self.results[key] = result
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
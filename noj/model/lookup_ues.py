@@ -4,6 +4,8 @@
 import logging
 import re
 import json
+import base64
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import *
 from noj.model import models
 from noj.model.models import Session
@@ -17,6 +19,31 @@ japanese = ''.join(kanji + katakana + hiragana)
 kana = ''.join(katakana + hiragana)
 kana_matcher = re.compile(r'^[%s\s]+$' % kana, re.U)
 
+# Unless exact counts are asked for, counting stops after this many rows
+MAX_ESTIMATED_COUNT = 1000
+
+# Lookup order. Usage examples are scored when they are committed; until
+# then n_score is 0, so they sort as the easiest.
+UE_SCORE = models.UsageExample.n_score
+
+def encode_cursor(after, position, count, count_is_exact):
+    """Returns the cursor of the page after the row with the sort key
+    values after, which is row number position of count results."""
+    return base64.urlsafe_b64encode(json.dumps({'after': after,
+        'position': position, 'count': count, 'exact': count_is_exact}))
+
+def decode_cursor(cursor, size):
+    """Returns (after, position, count, count_is_exact) of a cursor of
+    rows sorted on size columns."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        after = values['after']
+        if len(after) != size:
+            raise ValueError(after)
+        return after, values['position'], values['count'], values['exact']
+    except (TypeError, ValueError, KeyError):
+        raise Exception("invalid cursor: {!r}".format(cursor))
+
 
 class LookupUEs(object):
     def __init__(self):
@@ -32,21 +59,30 @@ class LookupUEs(object):
             return cls._lookup_entries_by_kanji(session, search_word, limit, offset)
 
     @classmethod
-    def lookup_ues_by_entry(cls, session, search_word, limit=None, offset=None):
+    def lookup_ues_by_entry(cls, session, search_word, limit=None, offset=None,
+                            exact_count=True, cursor=None):
+        """Usage examples of the entries of search_word, easiest first.
+
+        Pass the next_cursor of a result list as cursor to get the page after
+        it; offset is then ignored. The same goes for the other UE lookups.
+        """
         m = kana_matcher.match(search_word)
         if m:
             logging.info('kana search')
-            ues = cls._lookup_ues_by_kana(session, search_word, limit, offset)
+            ues = cls._lookup_ues_by_kana(session, search_word, limit, offset,
+                                          exact_count, cursor)
             logging.info('search complete')
             return ues
         else:
             logging.info('kanji search')
-            ues = cls._lookup_ues_by_kanji(session, search_word, limit, offset)
+            ues = cls._lookup_ues_by_kanji(session, search_word, limit, offset,
+                                           exact_count, cursor)
             logging.info('search complete')
             return ues
 
     @classmethod
-    def lookup_ues_by_definition(cls, session, search_word, limit=None, offset=None):
+    def lookup_ues_by_definition(cls, session, search_word, limit=None, offset=None,
+                                 exact_count=True, cursor=None):
         # TODO: need to test
         q_text = session.query(models.UsageExample).\
                 join(models.Definition).\
@@ -64,10 +100,12 @@ class LookupUEs(object):
                 options(joinedload_all(models.UsageExample.definition_assocs,
                     models.DefinitionHasUEs.definition, models.Definition.entry, 
                     models.Entry.library))
-        return cls._text_query_to_result_list(q_text, search_word, limit, offset)
+        return cls._text_query_to_result_list(q_text, search_word, limit, offset,
+                                              exact_count, cursor)
 
     @classmethod
-    def lookup_ues_by_expression(cls, session, search_word, limit=None, offset=None):
+    def lookup_ues_by_expression(cls, session, search_word, limit=None, offset=None,
+                                 exact_count=True, cursor=None):
         q_text = session.query(models.UsageExample).\
                 join(models.Expression).\
                 join(models.ExpressionConsistsOf).\
@@ -84,12 +122,14 @@ class LookupUEs(object):
                 options(joinedload_all(models.UsageExample.definition_assocs,
                     models.DefinitionHasUEs.definition, models.Definition.entry, 
                     models.Entry.library))
-        return cls._text_query_to_result_list(q_text, search_word, limit, offset)
+        return cls._text_query_to_result_list(q_text, search_word, limit, offset,
+                                              exact_count, cursor)
 
     @classmethod
-    def _lookup_ues_by_kana(cls, session, search_word, limit=None, offset=None):
+    def _lookup_ues_by_kana(cls, session, search_word, limit=None, offset=None,
+                            exact_count=True, cursor=None):
         # Note: Having subqueries was profiled to be much faster than relying
-        #       on joins. Also need an index on Definition.entry_id
+        #       on joins. The indexes are in noj.model.indexes
 
         # Get the entries matching the kana
         q_entry_ids = session.query(models.Entry.id).\
@@ -99,12 +139,14 @@ class LookupUEs(object):
 
         # Get the usage examples corresponding to the entry
         query = cls._entry_ues_query(session, q_entry_ids)
-        return cls._entry_query_to_result_list(query, search_word, limit, offset)
+        return cls._entry_query_to_result_list(query, search_word, limit, offset,
+                                               exact_count, cursor)
 
     @classmethod
-    def _lookup_ues_by_kanji(cls, session, search_word, limit=None, offset=None):
+    def _lookup_ues_by_kanji(cls, session, search_word, limit=None, offset=None,
+                             exact_count=True, cursor=None):
         # Note: Having subqueries was profiled to be much faster than relying
-        #       on joins. Also need an index on Definition.entry_id
+        #       on joins. The indexes are in noj.model.indexes
 
         # Get the entries matching the kanji
         q_entry_ids = session.query(models.Entry.id).\
@@ -114,7 +156,8 @@ class LookupUEs(object):
 
         # Get the usage examples corresponding to the entry
         query = cls._entry_ues_query(session, q_entry_ids)
-        return cls._entry_query_to_result_list(query, search_word, limit, offset)
+        return cls._entry_query_to_result_list(query, search_word, limit, offset,
+                                               exact_count, cursor)
 
     @classmethod
     def _entry_ues_query(cls, session, entry_ids):
@@ -171,31 +214,94 @@ class LookupUEs(object):
         return query
 
     @classmethod
-    def _query_count(cls, query):
-        count = query.count()
-        print count
-        return count
+    def _query_count(cls, query, exact_count=True):
+        """Returns (count, is_exact) for the rows of query.
+
+        The count query has no eager loads, so only the tables the filters
+        need are joined. Unless exact_count is True, counting stops after
+        MAX_ESTIMATED_COUNT rows and the count is a lower bound.
+        """
+        query = query.enable_eagerloads(False)
+        if exact_count:
+            return (query.count(), True)
+        count = query.limit(MAX_ESTIMATED_COUNT + 1).count()
+        if count > MAX_ESTIMATED_COUNT:
+            return (MAX_ESTIMATED_COUNT, False)
+        return (count, True)
 
     @classmethod
-    def _entry_query_to_result_list(cls, query, search_word, limit, offset):
-        count = cls._query_count(query)
-        res = cls._query_paging(query, limit, offset).all()
-        result_list = adts.UEResultList(count)
-        for ue, entry, definition in res:
-            ue_result = adts.UEResult(search_word, ue, definition, entry)
-            result_list.append(ue_result)
-        return result_list
+    def _page_count(cls, query, res, limit, offset, exact_count,
+                    known_count=None):
+        """Returns (count, is_exact), without a count query if the page
+        res is the last one, or if known_count (count, is_exact) from an
+        earlier page will do."""
+        if limit is None or 0 < len(res) < limit or (len(res) == 0 and not offset):
+            return ((offset or 0) + len(res), True)
+        if known_count is not None and (known_count[1] or not exact_count):
+            count, is_exact = known_count
+            return (max(count, (offset or 0) + len(res)), is_exact)
+        return cls._query_count(query, exact_count)
 
     @classmethod
-    def _text_query_to_result_list(cls, query, search_word, limit, offset):
-        count = cls._query_count(query)
-        res = cls._query_paging(query, limit, offset).all()
-        result_list = adts.UEResultList(count)
-        for ue in res:
-            ue_result = adts.UEResult(search_word, ue)
-            result_list.append(ue_result)
+    def _after(cls, keys, values):
+        """Returns the condition that the row's keys sort after values."""
+        if len(keys) == 1:
+            return keys[0] > values[0]
+        return or_(keys[0] > values[0],
+                   and_(keys[0] == values[0], cls._after(keys[1:], values[1:])))
+
+    @classmethod
+    def _keyset_page(cls, query, keys, limit, offset,
+                     exact_count, cursor, to_result):
+        """Returns a UEResultList of a page of query ordered by keys.
+
+        If cursor is given the page seeks to the rows after it instead of
+        skipping offset rows. to_result makes a UEResult of a row of query.
+        The result list has the cursor of the next page, if there may be one.
+        """
+        known_count = None
+        page = query.add_columns(*keys).order_by(*keys)
+        if cursor is not None:
+            after, offset, count, is_exact = decode_cursor(cursor, len(keys))
+            known_count = (count, is_exact)
+            page = page.filter(cls._after(keys, after))
+            res = cls._query_paging(page, limit, None).all()
+        else:
+            res = cls._query_paging(page, limit, offset).all()
+        count, is_exact = cls._page_count(query, res, limit, offset, exact_count,
+                                          known_count)
+        next_cursor = None
+        if limit is not None and len(res) == limit:
+            next_cursor = encode_cursor(list(res[-1][-len(keys):]),
+                                        (offset or 0) + len(res), count, is_exact)
+        result_list = adts.UEResultList(count, is_exact, next_cursor)
+        for row in res:
+            result_list.append(to_result(row))
         return result_list
 
+    @classmethod
+    def _entry_query_to_result_list(cls, query, search_word, limit, offset,
+                                    exact_count=True, cursor=None):
+        # A usage example is listed once for every definition it is under
+        keys = [UE_SCORE, models.UsageExample.id, models.Definition.id]
+        def to_result(row):
+            ue, entry, definition = row[:3]
+            return adts.UEResult(search_word, ue, definition, entry)
+        return cls._keyset_page(query, keys, limit, offset,
+                                exact_count, cursor, to_result)
+
+    @classmethod
+    def _text_query_to_result_list(cls, query, search_word, limit, offset,
+                                   exact_count=True, cursor=None):
+        # The joins repeat a usage example whose expression has the
+        # morpheme more than once, which would cut pages and counts short
+        query = query.distinct()
+        keys = [UE_SCORE, models.UsageExample.id]
+        def to_result(row):
+            return adts.UEResult(search_word, row[0])
+        return cls._keyset_page(query, keys, limit, offset,
+                                exact_count, cursor, to_result)
+
 def main():
     import sys
     from sqlalchemy import create_engine
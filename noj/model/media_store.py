@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+from functools import partial
+from sqlalchemy.sql import select
+from noj.model import db, models
+
+OBJECTS_DIR = 'objects'
+
+class MediaStore(object):
+    """Content-addressed store of media files under a media folder.
+
+    Each distinct file is stored once, at objects/<ab>/<sha1><ext> where
+    <ab> are the first two digits of its SHA-1, whatever its name was and
+    however many libraries use it. The mediafiles table is the hash->path
+    index, loaded into memory on first use, so checking whether a file is
+    already stored is a dict lookup. UsageExample.sound and image hold the
+    path relative to the media folder, which resolve() turns into an
+    absolute path; names from before the store resolve to the media folder
+    itself. The mediafiles table also records the source file each hash
+    was last added from, with its size and modification time, so a source
+    file is only hashed again, in this or a later store, if one of them
+    changed.
+    """
+    def __init__(self, root, session):
+        super(MediaStore, self).__init__()
+        self.root = root
+        self.session = session
+        self.paths = None # hash -> path relative to root
+        self.digests = None # (source path, size, mtime) -> hash
+
+    def resolve(self, path):
+        """Returns the absolute path of a stored file, or None."""
+        if path is None:
+            return None
+        # Stored paths use / on every platform
+        return os.path.join(self.root, *path.split('/'))
+
+    def add(self, src_path, copier=None):
+        """Stores a file, returns its path relative to the media folder.
+
+        If the file is not stored yet it is copied, by the given MediaCopier
+        if any. Returns None if src_path does not exist.
+        """
+        if self.paths is None:
+            self._load_index()
+        src_path = os.path.abspath(src_path)
+        try:
+            stat = os.stat(src_path)
+            key = (src_path, stat.st_size, stat.st_mtime)
+            digest = self.digests.get(key)
+            new_source = digest is None
+            if new_source:
+                digest = self._hash(src_path)
+                self.digests[key] = digest
+        except (IOError, OSError):
+            return None
+        source = {'size': stat.st_size, 'source_path': src_path,
+                  'source_mtime': stat.st_mtime}
+        if digest in self.paths and new_source:
+            media_files = models.MediaFile.__table__
+            self.session.execute(media_files.update().\
+                                 where(media_files.c.hash==digest).\
+                                 values(**source))
+
+        path = self.paths.get(digest)
+        if path is not None and os.path.exists(self.resolve(path)):
+            return path
+
+        extension = os.path.splitext(src_path)[1].lower()
+        path = '/'.join((OBJECTS_DIR, digest[:2], digest + extension))
+        dest_path = self.resolve(path)
+        dest_dir = os.path.dirname(dest_path)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if copier is not None:
+            copier.copy(src_path, dest_path)
+        else:
+            shutil.copy2(src_path, dest_path)
+
+        if digest not in self.paths:
+            db.insert(self.session, models.MediaFile, hash=digest, path=path,
+                      **source)
+        self.paths[digest] = path
+        return path
+
+    def _load_index(self):
+        media_files = models.MediaFile.__table__
+        s = select([media_files.c.hash, media_files.c.path,
+                    media_files.c.size, media_files.c.source_path,
+                    media_files.c.source_mtime])
+        self.paths = dict()
+        self.digests = dict()
+        for row in self.session.execute(s):
+            self.paths[row.hash] = row.path
+            if row.source_path is not None:
+                key = (row.source_path, row.size, row.source_mtime)
+                self.digests[key] = row.hash
+
+    def _hash(self, src_path):
+        h = hashlib.sha1()
+        with open(src_path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
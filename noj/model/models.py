@@ -14,6 +14,7 @@ from sqlalchemy.orm import (
 from sqlalchemy import (
     Column, 
     Integer, 
+    Float,
     String, 
     ForeignKey, 
     Table
@@ -54,6 +55,76 @@ class Library(Base):
     def breadcrumb_string(self):
         return self.name
 
+class ImportCheckpoint(Base):
+    """Records how far an unfinished import has been committed."""
+
+    __tablename__ = 'importcheckpoints'
+
+    id           = Column(Integer, primary_key=True)
+    importable   = Column(String, nullable=False, unique=True)
+    library_id   = Column(Integer, ForeignKey('libraries.id'), nullable=False)
+    entry_number = Column(Integer, nullable=False)
+    byte_offset  = Column(Integer, nullable=False) # read position, resuming parses from the start
+    state        = Column(String)
+    importable_size  = Column(Integer) # the importable the checkpoint is for
+    importable_mtime = Column(Float)
+
+    library = relationship('Library', backref='import_checkpoints')
+
+    unique_fields = ['importable']
+
+    def __repr__(self):
+        return "<ImportCheckpoint({!r}, {!r})>".format(self.importable, self.entry_number)
+
+class ValidatedImportable(Base):
+    """Content hash of an importable that passed schema validation."""
+
+    __tablename__ = 'validatedimportables'
+
+    id           = Column(Integer, primary_key=True)
+    content_hash = Column(String, nullable=False)
+    schema_hash  = Column(String, nullable=False)
+
+    __table_args__ = (UniqueConstraint('content_hash', 'schema_hash', name='_content_schema_uc'),
+                     )
+
+    unique_fields = ['content_hash', 'schema_hash']
+
+    def __repr__(self):
+        return "<ValidatedImportable({!r})>".format(self.content_hash)
+
+class MediaFile(Base):
+    """A file in the content-addressed media store, indexed by hash."""
+
+    __tablename__ = 'mediafiles'
+
+    id   = Column(Integer, primary_key=True)
+    hash = Column(String, nullable=False, unique=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer)
+    # The last file added with this content, so it is not hashed again
+    source_path  = Column(String)
+    source_mtime = Column(Float)
+
+    unique_fields = ['hash']
+
+    def __repr__(self):
+        return "<MediaFile({!r})>".format(self.path)
+
+class DatabaseGeneration(Base):
+    """Counts the commits that changed the libraries, so caches of lookup
+    results can tell when they are stale."""
+
+    __tablename__ = 'databasegeneration'
+
+    id         = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+
+    unique_fields = []
+
+    def __repr__(self):
+        return "<DatabaseGeneration({!r})>".format(self.generation)
+
 class LibraryType(Base):
     """Represents a Usage Example Library Type"""
 
@@ -177,7 +248,8 @@ class DefinitionHasUEs(Base):
     usage_example_id = Column(Integer, ForeignKey('usageexamples.id'), primary_key=True)
     definition_id    = Column(Integer, ForeignKey('definitions.id'), primary_key=True, index=True)
     number           = Column(Integer)
-    # really need index on this for create index dhu_idx on definitionhasues(definition_id);
+    # definition_id is also indexed in databases created before the index,
+    # see noj.model.indexes
 
     definition    = relationship('Definition', backref='ue_assocs')
     usage_example = relationship('UsageExample', backref='definition_assocs')
@@ -196,7 +268,7 @@ class Definition(Base):
     group       = Column(String)
     extra       = Column(String)
     entry_id    = Column(Integer, ForeignKey('entries.id'), nullable=False)
-    # ^ need an index on this
+    # ^ indexed in noj.model.indexes
     parent_id   = Column(Integer, ForeignKey('definitions.id'))
 
     entry = relationship('Entry', backref='definitions')
@@ -259,6 +331,8 @@ class UsageExample(Base):
     image         = Column(String)
     extra         = Column(String)
     is_validated  = Column(Integer, nullable=False, default=1)
+    n_score       = Column(Float, nullable=False, server_default='0') # kept by db.n_score_update, lower is easier
+    is_scored     = Column(Integer, nullable=False, server_default='0')
 
     expression = relationship('Expression', backref='usage_examples')
     library    = relationship('Library', backref='usage_examples')
@@ -268,23 +342,20 @@ class UsageExample(Base):
 
     unique_fields = ['library_id', 'expression_id']
 
-    @reconstructor
-    def init_on_load(self):
-        self.n_score = None
-
     def __repr__(self):
         return "<UsageExample({!r}, {!r})>".format(self.expression, self.meaning)
 
     def get_expression_score(self):
-        if self.n_score is None:
-            plus_n = len(self.expression.expression)/100
-            for ma in self.expression.morpheme_assocs:
-                m = ma.morpheme
-                m_count = m.expr_count or 0
-                if m_count < 3:
-                    plus_n += (3 - m_count)/3
-            self.n_score = plus_n
-        return self.n_score
+        # Usage examples are scored when their import is committed
+        if self.is_scored:
+            return self.n_score
+        plus_n = len(self.expression.expression)/100
+        for ma in self.expression.morpheme_assocs:
+            m = ma.morpheme
+            m_count = m.expr_count or 0
+            if m_count < 3:
+                plus_n += (3 - m_count)/3
+        return plus_n
 
     def get_definition_score(self):
         pass
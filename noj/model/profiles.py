@@ -5,6 +5,7 @@ import os
 from PyQt4.QtGui import QDesktopServices
 from puremvc.patterns.proxy import Proxy
 from noj.tools.check_platform import isWin, isMac
+from noj.model.media_store import MediaStore
 
 class ProfileManager(Proxy):
     """docstring for ProfileManager"""
@@ -46,6 +47,9 @@ class ProfileManager(Proxy):
     def media_path(self):
         return os.path.join(self.base, 'media')
 
+    def media_store(self, session):
+        return MediaStore(self.media_path(), session)
+
     def lookup_stylesheet_path(self):
         return os.path.join(self.base, 'lookup_stylesheet.css')
 
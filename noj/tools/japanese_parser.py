@@ -5,8 +5,8 @@
 # http://mecab.googlecode.com/svn/trunk/mecab/doc/bindings.html
 # https://github.com/dae/ankiplugins/blob/master/japanese/reading.py
 
+from __future__ import division
 import MeCab
-import re
 from jcconv import *
 
 BOS_EOS = 0
@@ -41,13 +41,91 @@ MORPHEME_TYPES = {
     u'その他':OTHER,
 }
 
+def _char_offsets(expression, utf8_length):
+    """Maps byte offsets in the UTF-8 encoding of expression to offsets in
+    expression, for every byte offset that starts a character."""
+    offsets = [0] * (utf8_length + 1)
+    utf8_pos = 0
+    for i, c in enumerate(expression):
+        code = ord(c)
+        if code < 0x80:
+            size = 1
+        elif code < 0x800:
+            size = 2
+        elif 0xD800 <= code < 0xDC00:
+            # High surrogate of a narrow build, the pair is 4 bytes
+            size = 4
+        elif 0xDC00 <= code < 0xE000:
+            continue
+        elif code < 0x10000:
+            size = 3
+        else:
+            size = 4
+        offsets[utf8_pos] = i
+        utf8_pos += size
+    offsets[utf8_length] = len(expression)
+    return offsets
+
+def _decode_feature(feature):
+    details = unicode(feature, encoding='utf-8').split(u',')
+    details = [u'' if d == u'*' else d for d in details]
+    return (MORPHEME_TYPES[details[0]], details[-3], kata2hira(details[-2]))
+
+class FeatureCache(object):
+    """LRU cache from raw MeCab feature strings to decoded
+    (type_, base, reading) tuples.
+
+    A few thousand feature strings make up almost all tokens, so repeated
+    tokens share one decoded tuple. The LRU order is approximated with two
+    generations of plain dicts, which keeps hits as cheap as a dict lookup:
+    when the recent generation holds half of max_features it becomes the
+    old generation, and the previous old generation is dropped. hits and
+    misses count lookups, to help choose max_features.
+    """
+    def __init__(self, max_features=20000):
+        super(FeatureCache, self).__init__()
+        self.max_features = max_features
+        self.recent = dict()
+        self.old = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.recent) + len(self.old)
+
+    def get(self, feature):
+        """Returns the decoded tuple for feature, decoding it on a miss."""
+        decoded = self.recent.get(feature)
+        if decoded is not None:
+            self.hits += 1
+            return decoded
+        decoded = self.old.pop(feature, None)
+        if decoded is not None:
+            self.hits += 1
+        else:
+            decoded = _decode_feature(feature)
+            self.misses += 1
+        if len(self.recent) >= max(self.max_features // 2, 1):
+            self.old = self.recent
+            self.recent = dict()
+        self.recent[feature] = decoded
+        return decoded
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return None
+        return self.hits / lookups
+
 class JapaneseParser(object):
     """A MeCab parser to parse japanese sentences into morphemes."""
 
-    def __init__(self, skipTypes=frozenset([BOS_EOS, SYMBOL])):
+    def __init__(self, skipTypes=frozenset([BOS_EOS, SYMBOL]),
+                 feature_cache_size=20000):
         super(JapaneseParser, self).__init__()
         self._parser = None
         self.skipTypes = skipTypes
+        self.feature_cache = FeatureCache(feature_cache_size)
 
     def parse(self, expression):
         """Parse a Japanese expression into morphemes. 
@@ -60,27 +138,26 @@ class JapaneseParser(object):
             An instance of JapaneseParseResults containing the 
             expression parsed into morphemes.
         """
+        if not isinstance(expression, unicode):
+            expression = unicode(expression, encoding='utf-8')
         expression_utf8 = expression.encode('utf-8')
+        char_offsets = _char_offsets(expression, len(expression_utf8))
         node = self.parser.parseToNode(expression_utf8)
         results = JapaneseParseResults()
         results.expression_unicode = expression
         results.expression_utf8 = expression_utf8
         position = 0
         while node:
-            feature = unicode(node.feature, encoding='utf-8')
-            details = re.split(',', feature)
-            for d in range(len(details)):
-                if details[d] == '*':
-                    details[d] = ''
-            type_ = MORPHEME_TYPES[details[0]]
+            type_, base, reading = self.feature_cache.get(node.feature)
             if type_ not in self.skipTypes:
-                morpheme = unicode(node.surface, encoding='utf-8')
                 utf8_pos = (node.rlength-node.length)+position
-                unicode_pos = len(unicode(expression_utf8[0:utf8_pos], encoding='utf-8'))
+                unicode_pos = char_offsets[utf8_pos]
+                morpheme = expression[unicode_pos:
+                                      char_offsets[utf8_pos+node.length]]
                 morpheme_obj = JapaneseMorpheme(
                     morpheme=morpheme,
-                    base=details[-3],
-                    reading=kata2hira(details[-2]),
+                    base=base,
+                    reading=reading,
                     length=len(morpheme),
                     position=unicode_pos,
                     type_=type_)
@@ -89,6 +166,26 @@ class JapaneseParser(object):
             node = node.next
         return results
 
+    def parse_many(self, expressions):
+        """Parse several Japanese expressions, returns a list of
+        JapaneseParseResults in the same order."""
+        return [self.parse(expression) for expression in expressions]
+
+    def dictionary_identity(self):
+        """Returns a string identifying the MeCab dictionaries in use.
+
+        The string changes when a dictionary is rebuilt or replaced, or
+        when different morpheme types are skipped.
+        """
+        parts = list()
+        info = self.parser.dictionary_info()
+        while info:
+            parts.append('{}:{}:{}'.format(info.filename, info.version,
+                                           info.size))
+            info = info.next
+        parts.append('skip:' + ','.join(str(t) for t in sorted(self.skipTypes)))
+        return unicode('|'.join(parts), encoding='utf-8')
+
     @property
     def parser(self):
         """Get the Japanese parser by lazy instantiation."""
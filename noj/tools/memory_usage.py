@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from noj.tools.check_platform import isMac
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes.
+
+    Returns None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac and in kilobytes elsewhere
+    if isMac:
+        return rss
+    return rss * 1024
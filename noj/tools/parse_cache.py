@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import sqlite3
+from noj.tools.japanese_parser import JapaneseParseResults, JapaneseMorpheme
+
+class ParseCache(object):
+    """On-disk cache of JapaneseParser results.
+
+    Results are kept in their own SQLite file, keyed by the SHA-1 of the
+    expression together with the identity of the MeCab dictionary that
+    parsed it (see JapaneseParser.dictionary_identity), so a different
+    dictionary never sees stale results. New results are committed every
+    commit_every writes and when commit() or close() is called.
+    """
+    def __init__(self, path, dictionary_identity, commit_every=10000):
+        super(ParseCache, self).__init__()
+        self.path = path
+        self.dictionary_identity = dictionary_identity.encode('utf-8')
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        # Losing the cache only costs reparsing, so skip the fsyncs
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parses '
+                          '(key BLOB PRIMARY KEY, morphemes TEXT NOT NULL)')
+
+    def _key(self, expression):
+        h = hashlib.sha1(self.dictionary_identity)
+        h.update(b'\0')
+        h.update(expression.encode('utf-8'))
+        return buffer(h.digest())
+
+    def __contains__(self, expression):
+        row = self.conn.execute('SELECT 1 FROM parses WHERE key=?',
+                                (self._key(expression),)).fetchone()
+        return row is not None
+
+    def get(self, expression):
+        """Returns the cached JapaneseParseResults or None."""
+        row = self.conn.execute('SELECT morphemes FROM parses WHERE key=?',
+                                (self._key(expression),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        results = JapaneseParseResults()
+        results.expression_unicode = expression
+        results.expression_utf8 = expression.encode('utf-8')
+        for m in json.loads(row[0]):
+            results.add_morpheme(JapaneseMorpheme(*m))
+        return results
+
+    def set(self, expression, results):
+        morphemes = [(m.morpheme, m.base, m.reading, m.length, m.position,
+                      m.type_) for m in results]
+        self.conn.execute('INSERT OR REPLACE INTO parses VALUES (?, ?)',
+                          (self._key(expression), json.dumps(morphemes)))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def parse(self, parser, expression):
+        """Returns the results for expression, parsing it on a miss."""
+        results = self.get(expression)
+        if results is None:
+            results = parser.parse(expression)
+            self.set(expression, results)
+        return results
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times JapaneseParser.parse against the previous implementation, which
+decoded the whole prefix of the expression for every morpheme.
+
+Usage: python parser_benchmark.py [repeat]
+"""
+from __future__ import division
+import re
+import sys
+import timeit
+from noj.tools.japanese_parser import (
+    JapaneseParser,
+    JapaneseParseResults,
+    JapaneseMorpheme,
+    MORPHEME_TYPES,
+    kata2hira,
+)
+
+SENTENCE = u'明日は今日よりやや暖かいでしょう。'
+
+def legacy_parse(parser, expression):
+    """JapaneseParser.parse before the byte offset table and feature cache."""
+    expression_utf8 = expression.encode('utf-8')
+    node = parser.parser.parseToNode(expression_utf8)
+    results = JapaneseParseResults()
+    position = 0
+    while node:
+        feature = unicode(node.feature, encoding='utf-8')
+        details = re.split(',', feature)
+        for d in range(len(details)):
+            if details[d] == '*':
+                details[d] = ''
+        type_ = MORPHEME_TYPES[details[0]]
+        if type_ not in parser.skipTypes:
+            morpheme = unicode(node.surface, encoding='utf-8')
+            utf8_pos = (node.rlength-node.length)+position
+            unicode_pos = len(unicode(expression_utf8[0:utf8_pos], encoding='utf-8'))
+            results.add_morpheme(JapaneseMorpheme(
+                morpheme=morpheme,
+                base=details[-3],
+                reading=kata2hira(details[-2]),
+                length=len(morpheme),
+                position=unicode_pos,
+                type_=type_))
+        position = position + node.rlength
+        node = node.next
+    return results
+
+def _as_tuples(results):
+    return [(m.morpheme, m.base, m.reading, m.length, m.position, m.type_)
+            for m in results]
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    parser = JapaneseParser()
+    print '{:>8} {:>12} {:>12} {:>8}'.format('chars', 'legacy (s)', 'parse (s)',
+                                             'speedup')
+    for sentences in (1, 10, 100, 1000):
+        text = SENTENCE * sentences
+        if _as_tuples(legacy_parse(parser, text)) != \
+           _as_tuples(parser.parse(text)):
+            raise Exception("parse results differ for {} chars".format(len(text)))
+        legacy = min(timeit.repeat(lambda: legacy_parse(parser, text),
+                                   repeat=repeat, number=1))
+        current = min(timeit.repeat(lambda: parser.parse(text),
+                                    repeat=repeat, number=1))
+        print '{:>8} {:>12.5f} {:>12.5f} {:>7.1f}x'.format(
+            len(text), legacy, current, legacy / current)
+
+    cache = parser.feature_cache
+    print 'feature cache: {} features, {} hits, {} misses'.format(
+        len(cache), cache.hits, cache.misses)
+
+if __name__ == '__main__':
+    main()
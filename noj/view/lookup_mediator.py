@@ -45,7 +45,7 @@ class LookupMediator(Mediator, IMediator, QObject):
         if notification.getName() == noj.AppFacade.LOOKUP_DONE:
             ues = notification.getBody()
             print 'lookup done'
-            self.html_ues_via_entry = u'<h1>Examples from Entry</h1>' + unicode(ues.to_html())
+            self.html_ues_via_entry = u'<h1>Examples from Entry ({})</h1>'.format(ues.count_string()) + unicode(ues.to_html())
             self.update_page()
         elif notification.getName() == noj.AppFacade.ENTRY_LOOKUP_DONE:
             entries = notification.getBody()
@@ -55,7 +55,7 @@ class LookupMediator(Mediator, IMediator, QObject):
         elif notification.getName() == noj.AppFacade.EXPRESSION_LOOKUP_DONE:
             ues = notification.getBody()
             print 'expression lookup done'
-            self.html_ues_via_expression = u'<h1>Examples from Expression</h1>' + unicode(ues.to_html())
+            self.html_ues_via_expression = u'<h1>Examples from Expression ({})</h1>'.format(ues.count_string()) + unicode(ues.to_html())
             self.update_page()
 
     def update_page(self):
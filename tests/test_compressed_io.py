@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bz2
+import gzip
+import unittest
+from io import BytesIO
+from noj.importers.compressed_io import (DecompressingReader, DECOMPRESSORS,
+                                         lzma)
+
+FIRST = b''.join(b'<entry>%d</entry>\n' % i for i in range(2000))
+SECOND = b''.join(b'<entry>%d</entry>\n' % i for i in range(2000, 3000))
+
+def gzip_compress(data):
+    f = BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as g:
+        g.write(data)
+    return f.getvalue()
+
+class DecompressingReaderTest(unittest.TestCase):
+    def reader(self, extension, compress, chunk_size):
+        first = compress(FIRST)
+        raw = BytesIO(first + compress(SECOND))
+        if chunk_size is None:
+            # The first stream ends exactly at the end of a chunk
+            chunk_size = len(first)
+        return DecompressingReader(raw, DECOMPRESSORS[extension], chunk_size)
+
+    def check_streams(self, extension, compress):
+        for chunk_size in (None, 7, 1 << 16):
+            self.assertEqual(self.reader(extension, compress,
+                                         chunk_size).read(), FIRST + SECOND)
+            reader = self.reader(extension, compress, chunk_size)
+            lines = list(iter(reader.readline, b''))
+            self.assertEqual(b''.join(lines), FIRST + SECOND)
+            self.assertEqual(len(lines), 3000)
+            reader = self.reader(extension, compress, chunk_size)
+            pieces = list(iter(lambda: reader.read(100), b''))
+            self.assertEqual(b''.join(pieces), FIRST + SECOND)
+
+    def test_gzip_streams(self):
+        self.check_streams('.gz', gzip_compress)
+
+    def test_bz2_streams(self):
+        self.check_streams('.bz2', bz2.compress)
+
+    @unittest.skipIf(lzma is None, 'backports.lzma is not installed')
+    def test_xz_streams(self):
+        self.check_streams('.xz', lzma.compress)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from noj.model import models, db, db_constants
+
+KNOWN = db_constants.KNOWN_EXAMPLES_ID
+
+def create_session():
+    engine = create_engine('sqlite://')
+    models.Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+class RecountTest(unittest.TestCase):
+    NUM_EXPRESSIONS = 1500
+    NUM_MORPHEMES = 500  # each morpheme is in 3 expressions
+
+    def setUp(self):
+        self.session = create_session()
+        morphemes = [{'id': m_id, 'morpheme': u'語{}'.format(m_id),
+                      'type_id': 1, 'status_id': 1}
+                     for m_id in range(1, self.NUM_MORPHEMES + 1)]
+        expressions = list()
+        components = list()
+        ues = list()
+        for e_id in range(1, self.NUM_EXPRESSIONS + 1):
+            expressions.append({'id': e_id,
+                                'expression': u'文{}'.format(e_id)})
+            components.append({'expression_id': e_id,
+                               'morpheme_id': e_id % self.NUM_MORPHEMES + 1,
+                               'position': 0, 'word_length': 1,
+                               'conjugation': u'', 'reading': u''})
+            ues.append({'id': e_id, 'expression_id': e_id, 'library_id': 1,
+                        'type_id': 1})
+        self.session.execute(models.Morpheme.__table__.insert(), morphemes)
+        self.session.execute(models.Expression.__table__.insert(), expressions)
+        self.session.execute(models.ExpressionConsistsOf.__table__.insert(),
+                             components)
+        self.session.execute(models.UsageExample.__table__.insert(), ues)
+        self.session.execute(models.ue_part_of_list.insert(),
+            [{'ue_list_id': KNOWN, 'usage_example_id': ue['id']} for ue in ues])
+        db.recount_morpheme_expr_counts(self.session, KNOWN)
+        db.score_new_usage_examples(self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def scores(self):
+        return dict(self.session.execute(
+            'SELECT id, n_score FROM usageexamples').fetchall())
+
+    def assertScoresFresh(self):
+        stored = self.scores()
+        self.session.execute(db.n_score_update())
+        self.assertEqual(stored, self.scores())
+
+    def test_full_recount(self):
+        self.session.execute(models.ue_part_of_list.delete())
+        db.recount_morpheme_expr_counts(self.session, KNOWN)
+        self.assertScoresFresh()
+
+    def test_incremental_recount_of_many_expressions(self):
+        # More than MAX_SQL_VARIABLES, so the recount runs in chunks that
+        # share morphemes
+        removed = range(1, 1201)
+        self.session.execute(models.ue_part_of_list.delete().where(
+            models.ue_part_of_list.c.usage_example_id.in_(removed)))
+        db.recount_morpheme_expr_counts(self.session, KNOWN, removed)
+        counts = dict(self.session.execute(
+            'SELECT id, expr_count FROM morphemes').fetchall())
+        self.assertEqual(sum(counts.values()),
+                         self.NUM_EXPRESSIONS - len(removed))
+        self.assertScoresFresh()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from noj.model import models
+from noj.tools.japanese_parser import JapaneseParser
+from noj.importers.abstract_importer import ReplaceImporterDecorator
+from noj.importers.dictionary_importer import (DictionaryWalker,
+                                               DictionaryImporterVisitor)
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(__file__), '..', 'schemas')
+EXAMPLE_PATH = os.path.join(SCHEMAS_DIR, 'example_dictionary_1.0.0a.xml')
+SCHEMA_PATH = os.path.join(SCHEMAS_DIR, 'dictionary_schema_1.0.0a.xsd')
+
+class InvalidDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(EXAMPLE_PATH) as f:
+            self.xml = f.read()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def count(self, orm_class):
+        return self.session.query(orm_class).count()
+
+    def run_import(self, xml, buffered, replace=False):
+        importable_path = os.path.join(self.tmp_dir, 'importable.xml')
+        with open(importable_path, 'w') as f:
+            f.write(xml)
+        walker = DictionaryWalker(importable_path, commit_every=1,
+                                  schema_path=SCHEMA_PATH)
+        visitor = DictionaryImporterVisitor(self.session, JapaneseParser(),
+                                            buffered=buffered)
+        if replace:
+            visitor = ReplaceImporterDecorator(visitor)
+        list(walker.import_generator(visitor))
+
+    def invalid_last_entry(self):
+        # The last entry is invalid, after the others have been committed
+        i = self.xml.rindex('</entry>')
+        return self.xml[:i] + '<invalid/>' + self.xml[i:]
+
+    def assertImportInvalid(self, xml):
+        for buffered in (False, True):
+            with self.assertRaises(etree.DocumentInvalid):
+                self.run_import(xml, buffered)
+            self.assertEqual(self.count(models.Library), 0)
+            self.assertEqual(self.count(models.Entry), 0)
+            self.assertEqual(self.count(models.UsageExample), 0)
+            self.assertEqual(self.count(models.ImportCheckpoint), 0)
+            self.assertEqual(self.count(models.ValidatedImportable), 0)
+
+    def test_invalid_entry_leaves_nothing_to_resume(self):
+        self.assertImportInvalid(self.invalid_last_entry())
+
+    def test_invalid_replacing_import_keeps_library(self):
+        for buffered in (False, True):
+            self.run_import(self.xml, buffered, replace=True)
+            library_id = self.session.query(models.Library.id).scalar()
+            num_entries = self.count(models.Entry)
+            with self.assertRaises(etree.DocumentInvalid):
+                self.run_import(self.invalid_last_entry(), buffered,
+                                replace=True)
+            self.assertEqual(self.session.query(models.Library.id).scalar(),
+                             library_id)
+            self.assertEqual(self.count(models.Entry), num_entries)
+            self.run_import(self.xml, buffered, replace=True)
+            self.assertNotEqual(self.session.query(models.Library.id).scalar(),
+                                library_id)
+            self.assertEqual(self.count(models.Entry), num_entries)
+
+    def test_invalid_root_attribute(self):
+        self.assertImportInvalid(self.xml.replace(
+            '<dictionary ', '<dictionary invalid="1" ', 1))
+
+    def test_missing_meta(self):
+        start = self.xml.index('<dictionary_meta>')
+        end = self.xml.index('</dictionary_meta>') + len('</dictionary_meta>')
+        self.assertImportInvalid(self.xml[:start] + self.xml[end:])
+
+    def test_invalid_element_between_entries(self):
+        self.assertImportInvalid(self.xml.replace(
+            '</entry>', '</entry><invalid/>', 1))
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.importable_path = os.path.join(self.tmp_dir, 'importable.xml')
+        shutil.copy(EXAMPLE_PATH, self.importable_path)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def import_generator(self, resumable=True):
+        walker = DictionaryWalker(self.importable_path, resumable=resumable,
+                                  commit_every=1)
+        visitor = DictionaryImporterVisitor(self.session, JapaneseParser())
+        return walker.import_generator(visitor)
+
+    def import_entries(self):
+        """Returns the entries of the importable, imported from scratch."""
+        list(self.import_generator(resumable=False))
+        entries = self.entries()
+        self.clear()
+        return entries
+
+    def clear(self):
+        self.session.execute(models.Entry.__table__.delete())
+        self.session.execute(models.Library.__table__.delete())
+        self.session.commit()
+
+    def interrupt_import(self):
+        generator = self.import_generator()
+        checkpoints = self.session.query(models.ImportCheckpoint)
+        while checkpoints.filter(models.ImportCheckpoint.entry_number > 1).\
+                count() == 0:
+            next(generator)
+        generator.close()
+
+    def entries(self):
+        return self.session.query(models.Entry.number, models.Entry.kana_raw).\
+            order_by(models.Entry.number).all()
+
+    def test_resume(self):
+        expected = self.import_entries()
+        self.interrupt_import()
+        list(self.import_generator())
+        self.assertEqual(self.session.query(models.Library).count(), 1)
+        self.assertEqual(self.entries(), expected)
+
+    def test_changed_importable_starts_over(self):
+        self.interrupt_import()
+        with open(EXAMPLE_PATH) as f:
+            xml = f.read()
+        # Same size, other entries at the same numbers
+        i = xml.index('<entry')
+        j = xml.index('</entry>') + len('</entry>')
+        with open(self.importable_path, 'w') as f:
+            f.write(xml[:i] + xml[j:] + ' ' * (j - i))
+        stat = os.stat(EXAMPLE_PATH)
+        os.utime(self.importable_path, (stat.st_atime, stat.st_mtime + 1))
+
+        list(self.import_generator())
+        self.assertEqual(self.session.query(models.Library).count(), 1)
+        self.assertEqual(self.session.query(models.ImportCheckpoint).count(), 0)
+        entries = self.entries()
+        self.clear()
+        self.assertEqual(self.import_entries(), entries)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from noj.model import models
+from noj.importers.import_writers import BufferedWriter
+from noj.importers.import_cache import ImporterCache
+
+def create_session():
+    engine = create_engine('sqlite://')
+    models.Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+class BufferedWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.session = create_session()
+        self.session.execute(models.Expression.__table__.insert(),
+                             [{'id': 1, 'expression': u'猫'}])
+        self.session.execute(models.Morpheme.__table__.insert(),
+                             [{'id': 1, 'morpheme': u'猫', 'type_id': 1,
+                               'status_id': 1}])
+        self.statements = list()
+        event.listen(self.session.connection(), 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                         self.statements.append(statement))
+
+    def tearDown(self):
+        self.session.close()
+
+    def lookups(self):
+        return [s for s in self.statements if 'WHERE' in s]
+
+    def test_existing_rows_are_remapped_at_flush(self):
+        writer = BufferedWriter(self.session)
+        expression_id = writer.insert(models.Expression, expression=u'猫')[0]
+        writer.insert_many(models.ExpressionConsistsOf, [
+            {'expression_id': expression_id, 'morpheme_id': 1, 'position': 0,
+             'word_length': 1, 'conjugation': u'', 'reading': u''}])
+        self.assertEqual(writer.insert(models.Expression, expression=u'猫'),
+                         (expression_id, False))
+        writer.insert(models.Expression, expression=u'犬')
+        self.assertEqual(self.lookups(), [])
+        writer.flush()
+        self.assertEqual(self.session.execute(
+            'SELECT id, expression FROM expressions ORDER BY id').fetchall(),
+            [(1, u'猫'), (3, u'犬')])
+        self.assertEqual(self.session.execute(
+            'SELECT expression_id FROM expressionconsistsof').fetchall(),
+            [(1,)])
+
+    def test_existing_rows_are_not_treated_as_new(self):
+        cache = ImporterCache()
+        writer = BufferedWriter(self.session, cache=cache)
+        library_id = writer.insert_orm(models.Library(name=u'辞書', type_id=1))[0]
+        called = list()
+        for expression in (u'猫', u'犬'):
+            expression_id, new = writer.insert(models.Expression,
+                                               expression=expression)
+            self.assertIsNone(new)
+            cache.expressions.set(expression, expression_id)
+            writer.when_new(models.Expression, expression_id,
+                            lambda expression=expression:
+                                called.append(expression))
+        ue_id = writer.insert(models.UsageExample, library_id=library_id,
+                              expression_id=cache.expressions.get(u'猫'),
+                              type_id=1)[0]
+        writer.flush()
+        self.assertEqual(called, [u'犬'])
+        self.assertEqual(writer.remaps, {})
+        # The cache points at the existing row, so later rows refer to it
+        self.assertEqual(cache.expressions.get(u'猫'), 1)
+        self.assertEqual(writer.insert(models.UsageExample,
+                                       library_id=library_id, expression_id=1,
+                                       type_id=1), (ue_id, False))
+        writer.flush()
+        self.assertEqual(self.session.execute(
+            'SELECT expression_id FROM usageexamples').fetchall(), [(1,)])
+
+    def test_no_lookups_for_covered_tables_and_new_libraries(self):
+        cache = ImporterCache()
+        cache.warm(self.session)
+        writer = BufferedWriter(self.session, cache=cache)
+        del self.statements[:]
+        library_id = writer.insert_orm(models.Library(name=u'辞書', type_id=1))[0]
+        expression_id = writer.insert(models.Expression, expression=u'犬')[0]
+        for _ in range(2):
+            ue_id, new = writer.insert(models.UsageExample,
+                                       library_id=library_id,
+                                       expression_id=expression_id,
+                                       type_id=1)
+            writer.flush()
+        self.assertFalse(new)
+        self.assertEqual(self.lookups(), [])
+        self.assertEqual(self.session.execute(
+            'SELECT count(*) FROM usageexamples').scalar(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
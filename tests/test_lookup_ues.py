@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from noj.model import models
+from noj.model.lookup_ues import LookupUEs
+
+def create_session():
+    engine = create_engine('sqlite://')
+    models.Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+class PagingTest(unittest.TestCase):
+    NUM_UES = 40
+    PAGE = 7
+
+    def setUp(self):
+        self.session = create_session()
+        execute = lambda orm_class, rows: self.session.execute(
+            orm_class.__table__.insert(), rows)
+        execute(models.Library, [{'id': 1, 'name': u'辞書', 'type_id': 1}])
+        execute(models.EntryFormat, [{'id': 1, 'name': u'J-J1'}])
+        execute(models.Morpheme, [
+            {'id': 1, 'morpheme': u'猫', 'type_id': 1, 'status_id': 1},
+            {'id': 2, 'morpheme': u'ねこ', 'type_id': 1, 'status_id': 1}])
+        execute(models.Entry, [{'id': 1, 'number': 1, 'library_id': 1,
+                                'format_id': 1}])
+        execute(models.EntryHasKana, [{'entry_id': 1, 'kana_id': 2}])
+        execute(models.Definition, [{'id': 1, 'entry_id': 1},
+                                    {'id': 2, 'entry_id': 1}])
+        expressions = list()
+        components = list()
+        ues = list()
+        definition_ues = list()
+        for i in range(1, self.NUM_UES + 1):
+            expressions.append({'id': i, 'expression': u'猫{}猫'.format(i)})
+            # The morpheme is in every expression twice
+            for position in (0, 2):
+                components.append({'expression_id': i, 'morpheme_id': 1,
+                                   'position': position, 'word_length': 1,
+                                   'conjugation': u'', 'reading': u''})
+            # Scores tie in fours; every fifth example is not scored yet
+            scored = i % 5 != 0
+            ues.append({'id': i, 'expression_id': i, 'library_id': 1,
+                        'type_id': 1, 'n_score': (i % 4) if scored else 0,
+                        'is_scored': int(scored)})
+            definition_ues.append({'usage_example_id': i, 'definition_id': 1})
+            if i % 2 == 0:
+                definition_ues.append({'usage_example_id': i,
+                                       'definition_id': 2})
+        execute(models.Expression, expressions)
+        execute(models.ExpressionConsistsOf, components)
+        execute(models.UsageExample, ues)
+        execute(models.DefinitionHasUEs, definition_ues)
+
+    def tearDown(self):
+        self.session.close()
+
+    def keys(self, result_list):
+        return [(r.usage_example.n_score, r.usage_example.id,
+                 r.definition and r.definition.id) for r in result_list]
+
+    def assertPagingMatches(self, method, search_word, num_results):
+        lookup = getattr(LookupUEs, method)
+        everything = self.keys(lookup(self.session, search_word))
+        self.assertEqual(len(everything), num_results)
+        self.assertEqual(everything, sorted(everything))
+
+        by_offset = list()
+        for offset in range(0, num_results, self.PAGE):
+            page = lookup(self.session, search_word, self.PAGE, offset)
+            self.assertEqual(page.count, num_results)
+            by_offset.extend(self.keys(page))
+        self.assertEqual(by_offset, everything)
+
+        by_cursor = list()
+        cursor = None
+        while True:
+            page = lookup(self.session, search_word, self.PAGE, cursor=cursor)
+            self.assertEqual(page.count, num_results)
+            by_cursor.extend(self.keys(page))
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(by_cursor, everything)
+
+    def test_entry_lookup(self):
+        # Listed once for every definition
+        self.assertPagingMatches('lookup_ues_by_entry', u'ねこ',
+                                 self.NUM_UES + self.NUM_UES // 2)
+
+    def test_expression_lookup(self):
+        # Listed once, however often the expression has the morpheme
+        self.assertPagingMatches('lookup_ues_by_expression', u'猫',
+                                 self.NUM_UES)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from noj.model import models
+from noj.model.media_store import MediaStore
+
+class MediaStoreTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'media')
+        self.src_path = os.path.join(self.tmp_dir, 'a.mp3')
+        with open(self.src_path, 'wb') as f:
+            f.write(b'sound')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def store(self):
+        """Returns a new store that counts the files it hashes."""
+        store = MediaStore(self.root, self.session)
+        store.hashed = list()
+        hash_file = store._hash
+        def counted_hash(src_path):
+            store.hashed.append(src_path)
+            return hash_file(src_path)
+        store._hash = counted_hash
+        return store
+
+    def test_sources_are_hashed_once_across_stores(self):
+        store = self.store()
+        path = store.add(self.src_path)
+        self.assertEqual(len(store.hashed), 1)
+        self.assertTrue(os.path.exists(store.resolve(path)))
+        self.session.commit()
+
+        store = self.store()
+        self.assertEqual(store.add(self.src_path), path)
+        self.assertEqual(store.hashed, [])
+
+        # A changed source is hashed again and stored under its new hash
+        with open(self.src_path, 'wb') as f:
+            f.write(b'other sound')
+        self.assertNotEqual(store.add(self.src_path), path)
+        self.assertEqual(len(store.hashed), 1)
+        self.assertEqual(self.session.query(models.MediaFile).count(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from noj.model import models
+from noj.tools.japanese_parser import JapaneseParser
+from noj.importers.dictionary_importer import (DictionaryWalker,
+                                               DictionaryImporterVisitor)
+from noj.importers.staging import staged_import
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(__file__), '..', 'schemas',
+                            'example_dictionary_1.0.0a.xml')
+
+# Tables compared row for row, ids included
+TABLES = ['libraries', 'entries', 'definitions', 'usageexamples',
+          'expressions', 'morphemes', 'expressionconsistsof',
+          'definitionconsistsof', 'definitionhasues', 'entryhaskana',
+          'entryhaskanji', 'uetypes', 'entryformats']
+
+class MergeStagingDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def import_twice(self, name, staged):
+        """Imports the example dictionary twice, the second time into a
+        staging database if staged, and returns the rows of TABLES."""
+        engine = create_engine('sqlite:///' + os.path.join(self.tmp_dir, name))
+        models.Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        for i in range(2):
+            walker = DictionaryWalker(EXAMPLE_PATH, resumable=False)
+            if staged and i == 1:
+                with staged_import(session, self.tmp_dir) as staging_session:
+                    visitor = DictionaryImporterVisitor(staging_session,
+                        JapaneseParser(), buffered=True)
+                    list(walker.import_generator(visitor))
+            else:
+                visitor = DictionaryImporterVisitor(session, JapaneseParser(),
+                                                    buffered=True)
+                list(walker.import_generator(visitor))
+        session.commit()
+        rows = dict((table, sorted(tuple(row) for row in
+                                   session.execute('SELECT * FROM ' + table)))
+                    for table in TABLES)
+        session.close()
+        engine.dispose()
+        return rows
+
+    def test_merge_matches_direct_import(self):
+        # The second import reuses the expressions and morphemes of the
+        # first and adds a library, so merging remaps both kinds of ids
+        direct = self.import_twice('direct.sqlite', False)
+        staged = self.import_twice('staged.sqlite', True)
+        self.assertEqual(len(direct['libraries']), 2)
+        for table in TABLES:
+            self.assertEqual(staged[table], direct[table], table)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['direct.sqlite', 'staged.sqlite'])
+
+if __name__ == '__main__':
+    unittest.main()